@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#Microbenchmarks of the lookup pipeline: the memory cache, reduce_domain, database reads and update file loading.
+#python benchmarks/bench_micro.py --output micro.json
+import argparse
+import datetime
+import pathlib
+import random
+import shutil
+import tempfile
+import time
+
+import common
+import bench_reduce_domain
+import include.expiring_cache as expiring_cache
+import include.public_suffix as public_suffix
+import include.database_io as database_io
+import include.schema as schema
+
+
+def zipf_keys(keys, count, skew=1.1, seed=1):
+    #Index i is requested with probability proportional to 1/(i+1)**skew like real domain popularity
+    rand = random.Random(seed)
+    weights = [1 / (rank + 1) ** skew for rank in range(len(keys))]
+    return rand.choices(keys, weights=weights, k=count)
+
+def timed(name, function, items, **extra):
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    entry = common.result(name, len(items), time.perf_counter() - start, **extra)
+    common.print_result(entry)
+    return entry
+
+def bench_cache(size, operations):
+    results = []
+    keys = [f"domain{n}.com" for n in range(size)]
+    for name, cache in (("cache", expiring_cache.ExpiringCache(size)), ("sharded_cache", expiring_cache.ShardedExpiringCache(size, shards=8))):
+        results.append(timed(f"{name}.set (fill)", lambda key: cache.set(key, b"x" * 150), keys))
+        results.append(timed(f"{name}.get (zipf hits)", cache.get, zipf_keys(keys, operations)))
+        results.append(timed(f"{name}.get (misses)", cache.get, [f"missing{n}.com" for n in range(operations)]))
+        new_keys = [f"new{n}.com" for n in range(operations)]
+        results.append(timed(f"{name}.set (evict)", lambda key: cache.set(key, b"x" * 150), new_keys))
+        results[-1]["evictions"] = cache.stats.evict
+    return results
+
+def bench_reduce(psl_file, operations):
+    names = bench_reduce_domain.hostnames(operations, 50000)
+    results = [timed("reduce_domain (legacy)", public_suffix.legacy_reduce_domain, names)]
+    if pathlib.Path(psl_file).exists():
+        psl = public_suffix.PublicSuffixList(psl_file)
+        results.append(timed("reduce_domain (psl + memo)", psl.reduce_domain, names))
+    return results
+
+def bench_database(rows, operations, workdir):
+    filename = str(pathlib.Path(workdir) / "bench.db")
+    database = database_io.DomainStatsDatabase(filename)
+    database.create_file(filename)
+    database = database_io.DomainStatsDatabase(filename)
+    update_file = pathlib.Path(workdir) / "update.txt"
+    domains = [f"benchdomain{n}.com" for n in range(rows)]
+    with open(update_file, "w") as fh:
+        for n, domain in enumerate(domains):
+            web = datetime.datetime(2000, 1, 1) + datetime.timedelta(minutes=n)
+            fh.write(f"+,{domain},{web},{web + datetime.timedelta(days=365*30)}\n")
+    start = time.perf_counter()
+    database.process_update_file(str(update_file), defer_indexes=True)
+    results = [common.result("process_update_file", rows, time.perf_counter() - start)]
+    common.print_result(results[-1])
+    #Give every row a seen_by_you so get_record measures the read path without first contact writes
+    with database.connection() as db:
+        if database.schema >= 2:
+            db.execute(f"update domains set seen_by_you=1577836800, flags=flags & ~{schema.FIRST_CONTACT}")
+        else:
+            db.execute("update domains set seen_by_you='2020-01-01 00:00:00'")
+        db.commit()
+    results.append(timed("get_record (zipf hits)", database.get_record, zipf_keys(domains, operations)))
+    results.append(timed("get_record (misses)", database.get_record, [f"missing{n}.com" for n in range(operations)]))
+    batch = zipf_keys(domains, operations)
+    start = time.perf_counter()
+    for offset in range(0, len(batch), 500):
+        database.get_records(batch[offset:offset+500])
+    results.append(common.result("get_records (500 per call)", len(batch), time.perf_counter() - start))
+    common.print_result(results[-1])
+    database.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--operations', type=int, default=200000, help='Operations per benchmark')
+    parser.add_argument('--cache-size', type=int, default=65536, help='Memory cache maxsize')
+    parser.add_argument('--rows', type=int, default=200000, help='Rows loaded into the benchmark database')
+    parser.add_argument('--psl', default="public_suffix_list.dat", help='Public Suffix List to benchmark if it exists')
+    parser.add_argument('-o','--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="domain_stats_bench")
+    try:
+        results = bench_cache(args.cache_size, args.operations)
+        results += bench_reduce(args.psl, args.operations)
+        results += bench_database(args.rows, args.operations // 10, workdir)
+    finally:
+        shutil.rmtree(workdir)
+    common.write_report(args.output, "micro", results, arguments=vars(args))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+#Microbenchmark of host name to registered domain reduction.
+#Compares the legacy reduce_domain rules with the compiled public suffix trie with and without the LRU memo.
+#Run it from the domain_stats directory: python benchmarks/bench_reduce_domain.py --psl public_suffix_list.dat
+import argparse
+import pathlib
+import random
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import include.public_suffix as public_suffix
+
+SUFFIXES = ["com", "net", "org", "co.uk", "com.au", "de", "io", "gov.uk", "ne.jp", "com.br", "k12.ca.us", "edu", "info", "ru", "cn"]
+
+def hostnames(count, unique):
+    rand = random.Random(1)
+    names = []
+    for n in range(unique):
+        labels = [rand.choice(["www", "mail", "cdn", "api", "static", "a.b", "login"]) for _ in range(rand.randrange(0, 3))]
+        names.append(".".join(labels + [f"domain{n}", rand.choice(SUFFIXES)]))
+    #Requests are skewed toward a few popular names
+    return [names[min(int(rand.paretovariate(1.2)) - 1, unique - 1)] for _ in range(count)]
+
+def measure(name, function, names):
+    start = time.perf_counter()
+    for host in names:
+        function(host)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {len(names)/elapsed:>14,.0f} calls/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--psl', default="public_suffix_list.dat", help='Path to a Public Suffix List file')
+    parser.add_argument('--count', type=int, default=500000, help='Number of lookups')
+    parser.add_argument('--unique', type=int, default=50000, help='Number of distinct host names')
+    args = parser.parse_args()
+
+    names = hostnames(args.count, args.unique)
+    measure("legacy reduce_domain", public_suffix.legacy_reduce_domain, names)
+    if not pathlib.Path(args.psl).exists():
+        print(f"{args.psl} not found. Download it with database_admin --update-psl to compare the trie.")
+        sys.exit(0)
+    start = time.perf_counter()
+    psl = public_suffix.PublicSuffixList(args.psl, memo_size=0)
+    print(f"{'compile trie':<28} {time.perf_counter() - start:>14.3f} seconds")
+    measure("trie, no memo", psl._reduce, names)
+    psl = public_suffix.PublicSuffixList(args.psl, memo_size=65536)
+    measure("trie with memo", psl.reduce_domain, names)
+    start = time.perf_counter()
+    psl.reduce_domains(names)
+    print(f"{'reduce_domains (batch)':<28} {args.count/(time.perf_counter() - start):>14,.0f} calls/sec")
+    print(psl.cache_info())
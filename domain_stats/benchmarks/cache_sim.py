@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#Replays a trace of domain lookups through the memory cache with each eviction policy and reports the hit ratio.
+#Every miss is a database or RDAP lookup on the server so a higher hit ratio at the same cached_max_items is less work.
+#The trace is the domains in log files (read like utils/enrich.py reads them) or, without files, a synthetic Zipf
+#mix of popular domains interrupted by bursts of one off domains like a DGA or a crawler produces.
+#  python benchmarks/cache_sim.py dns.log.gz --sizes 10000 65536 -o sim.json
+#  python benchmarks/cache_sim.py --requests 1000000 --burst-every 100000 --burst-size 50000
+import argparse
+import itertools
+import pathlib
+import random
+import time
+
+import common
+import include.cache_policy as cache_policy
+import include.expiring_cache as expiring_cache
+import include.public_suffix as public_suffix
+import utils.enrich as enrich
+
+
+def synthetic_trace(unique, requests, skew, burst_every, burst_size, seed):
+    rand = random.Random(seed)
+    domains = [f"domain{n}.com" for n in range(unique)]
+    weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(unique)))
+    trace = []
+    while len(trace) < requests:
+        trace += rand.choices(domains, cum_weights=weights, k=min(burst_every, requests - len(trace)))
+        trace += [f"burst{rand.getrandbits(48):x}.com" for _ in range(min(burst_size, requests - len(trace)))]
+    return trace
+
+def log_trace(filenames, column, delimiter, field, psl_file, requests):
+    domains = enrich.read_domains(filenames, column, delimiter, field)
+    if pathlib.Path(psl_file).exists():
+        #The server caches the reduced domain
+        public_suffix.load(psl_file)
+        domains = public_suffix.reduce_domains(domains)
+    return list(itertools.islice(domains, requests))
+
+def simulate(trace, policy, size):
+    #-1 never expires so only the eviction policy decides what is cached
+    cache = expiring_cache.ExpiringCache(size, -1, policy)
+    get, put = cache.get, cache.set
+    start = time.perf_counter()
+    for domain in trace:
+        if get(domain) is None:
+            put(domain, True)
+    elapsed = time.perf_counter() - start
+    hit_ratio = cache.stats.hit / len(trace) if trace else 0
+    return common.result(f"{policy} size {size}", len(trace), elapsed, policy=policy, size=size,
+                         hit_ratio=round(hit_ratio, 4), misses=cache.stats.miss, evictions=cache.stats.evict)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', nargs='*', help='Log files to replay. gzip files are detected. Without files a synthetic trace is used.')
+    parser.add_argument('--column', type=int, help='0 based column of the domain in each line. By default the whole line or a Zeek log\'s query field.')
+    parser.add_argument('--delimiter', help='Column delimiter. Defaults to whitespace or the Zeek log\'s separator.')
+    parser.add_argument('--field', help='Zeek field with the domain. Defaults to query.')
+    parser.add_argument('--psl', default='public_suffix_list.dat', help='Public Suffix List used to reduce the domains in the logs')
+    parser.add_argument('-s','--sizes', type=int, nargs='+', default=[1000, 10000, 65536], help='Cache sizes to simulate')
+    parser.add_argument('-p','--policies', nargs='+', default=list(cache_policy.POLICIES), choices=list(cache_policy.POLICIES))
+    parser.add_argument('-n','--requests', type=int, default=1000000, help='Lookups in the synthetic trace or the most read from the logs')
+    parser.add_argument('--unique', type=int, default=200000, help='Distinct popular domains in the synthetic trace')
+    parser.add_argument('--skew', type=float, default=0.9, help='Zipf exponent of the synthetic popularity distribution')
+    parser.add_argument('--burst-every', type=int, default=100000, help='Popular lookups between bursts of one off domains')
+    parser.add_argument('--burst-size', type=int, default=20000, help='One off domains in each burst. 0 for no bursts.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o','--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.input:
+        trace = log_trace(args.input, args.column, args.delimiter, args.field, args.psl, args.requests)
+    else:
+        trace = synthetic_trace(args.unique, args.requests, args.skew, args.burst_every, args.burst_size, args.seed)
+    print(f"Replaying {len(trace)} lookups of {len(set(trace))} distinct domains")
+    results = []
+    for size in args.sizes:
+        for policy in args.policies:
+            entry = simulate(trace, policy, size)
+            print(f"{entry['name']:<32} hit ratio {entry['hit_ratio']:>7.2%}  {entry['ops_per_sec']:>12,.0f} lookups/sec")
+            results.append(entry)
+    common.write_report(args.output, "cache_sim", results, arguments=vars(args), requests=len(trace))
@@ -0,0 +1,55 @@
+#Helpers shared by the benchmarks. Every benchmark writes the same JSON report so runs can be compared with compare.py.
+import datetime
+import json
+import pathlib
+import platform
+import resource
+import sys
+
+#Make include.* importable when a benchmark is run from any directory
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+
+def percentile(samples, percent):
+    samples = sorted(samples)
+    if not samples:
+        return 0
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+def rss_kb(pid=None):
+    """Resident set size of pid (this process if None) in kilobytes. Peak RSS where /proc is not available."""
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if pid:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def result(name, operations, seconds, latencies=None, **extra):
+    """One benchmark result. latencies is a list of per operation seconds if they were measured."""
+    entry = {"name": name, "operations": operations, "seconds": round(seconds, 6),
+             "ops_per_sec": round(operations / seconds, 1) if seconds else 0}
+    if latencies:
+        entry["p50_ms"] = round(percentile(latencies, 50) * 1000, 4)
+        entry["p99_ms"] = round(percentile(latencies, 99) * 1000, 4)
+    entry.update(extra)
+    return entry
+
+def print_result(entry):
+    latency = f"  p50 {entry['p50_ms']:.3f}ms  p99 {entry['p99_ms']:.3f}ms" if "p50_ms" in entry else ""
+    print(f"{entry['name']:<32} {entry['ops_per_sec']:>14,.0f} ops/sec{latency}")
+
+def write_report(filename, suite, results, **extra):
+    report = {"suite": suite, "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+              "python": platform.python_version(), "platform": platform.platform(), "rss_kb": rss_kb(),
+              "results": results}
+    report.update(extra)
+    if filename:
+        with open(filename, "w") as fh:
+            json.dump(report, fh, indent=2)
+        print(f"Report written to {filename}")
+    return report
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+#Compare two benchmark reports: python benchmarks/compare.py baseline.json candidate.json
+import argparse
+import json
+
+
+def compare(baseline, candidate, threshold):
+    before = {entry["name"]: entry for entry in baseline["results"]}
+    regressions = 0
+    print(f"{'benchmark':<32} {'baseline':>14} {'candidate':>14} {'change':>8}")
+    for entry in candidate["results"]:
+        old = before.get(entry["name"])
+        if not old or not old["ops_per_sec"]:
+            print(f"{entry['name']:<32} {'':>14} {entry['ops_per_sec']:>14,.0f}")
+            continue
+        change = entry["ops_per_sec"] / old["ops_per_sec"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{entry['name']:<32} {old['ops_per_sec']:>14,.0f} {entry['ops_per_sec']:>14,.0f} {change:>+8.1%}{flag}")
+        if "p99_ms" in entry and "p99_ms" in old:
+            print(f"{'  p99 ms':<32} {old['p99_ms']:>14.3f} {entry['p99_ms']:>14.3f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline', help='Report from the previous run')
+    parser.add_argument('candidate', help='Report from the new run')
+    parser.add_argument('-t','--threshold', type=float, default=0.10, help='Slowdown reported as a regression (0.10 = 10%%)')
+    args = parser.parse_args()
+    with open(args.baseline) as fh:
+        baseline = json.load(fh)
+    with open(args.candidate) as fh:
+        candidate = json.load(fh)
+    regressions = compare(baseline, candidate, args.threshold)
+    raise SystemExit(1 if regressions else 0)
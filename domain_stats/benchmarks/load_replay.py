@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+#Replays domain lookups against a running domain_stats server and reports throughput, latency and server memory.
+#Popularity follows a Zipf distribution so a few domains get most of the requests like real DNS traffic.
+#  python benchmarks/stub_rdap.py &          (rdap mode only, with rdap_url: http://127.0.0.1:8100)
+#  python domain_stats &
+#  python benchmarks/load_replay.py --database domain_stats.db --pid $(pgrep -f "python domain_stats") -o load.json
+import argparse
+import http.client
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import common
+import stub_rdap
+
+
+def load_domains(args):
+    if args.domains:
+        with open(args.domains) as fh:
+            domains = [line.strip() for line in fh if line.strip()]
+    else:
+        db = sqlite3.connect(f"file:{args.database}?mode=ro", uri=True)
+        domains = [row[0] for row in db.execute("select domain from domains order by random() limit ?", (args.unique,))]
+        db.close()
+    #Domains the server has never seen have to be resolved by RDAP or the ISC
+    new_domains = int(len(domains) * args.new_fraction)
+    domains += [f"loadtest{random.getrandbits(48):x}.com" for _ in range(new_domains)]
+    random.Random(args.seed).shuffle(domains)
+    return domains
+
+def request_mix(domains, count, skew, seed):
+    rand = random.Random(seed)
+    weights = [1 / (rank + 1) ** skew for rank in range(len(domains))]
+    return rand.choices(domains, weights=weights, k=count)
+
+def replay(address, requests, latencies, errors):
+    host, port = address
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    for domain in requests:
+        start = time.perf_counter()
+        try:
+            connection.request("GET", "/" + domain)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=60)
+            continue
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u','--url', default="http://127.0.0.1:8000", help='Base URL of the domain_stats server')
+    parser.add_argument('--domains', help='File with one domain per line to replay')
+    parser.add_argument('--database', default="domain_stats.db", help='Sample domains from this database when --domains is not given')
+    parser.add_argument('--unique', type=int, default=20000, help='Number of distinct domains sampled from the database')
+    parser.add_argument('--new-fraction', type=float, default=0.05, help='Extra never seen domains as a fraction of the distinct domains')
+    parser.add_argument('-n','--requests', type=int, default=100000, help='Total requests to send')
+    parser.add_argument('-c','--concurrency', type=int, default=32, help='Client threads each with a keep-alive connection')
+    parser.add_argument('--skew', type=float, default=1.0, help='Zipf exponent of the popularity distribution')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--pid', type=int, help='Server process id. Its RSS is included in the report.')
+    parser.add_argument('--stub-rdap-port', type=int, help='Also run the stub RDAP server on this port')
+    parser.add_argument('--stub-rdap-delay-ms', type=float, default=50)
+    parser.add_argument('-o','--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.stub_rdap_port:
+        stub_rdap.start(args.stub_rdap_port, args.stub_rdap_delay_ms)
+    url = urllib.parse.urlsplit(args.url)
+    address = (url.hostname, url.port or 80)
+    domains = load_domains(args)
+    mix = request_mix(domains, args.requests, args.skew, args.seed)
+    latencies, errors = [], []
+    threads = [threading.Thread(target=replay, args=(address, mix[n::args.concurrency], latencies, errors)) for n in range(args.concurrency)]
+    rss_before = common.rss_kb(args.pid) if args.pid else 0
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    entry = common.result("load_replay", len(latencies), elapsed, latencies, errors=len(errors), distinct_domains=len(domains),
+                          concurrency=args.concurrency, server_rss_kb_before=rss_before, server_rss_kb=common.rss_kb(args.pid) if args.pid else 0)
+    common.print_result(entry)
+    print(f"{len(errors)} errors. Server RSS {entry['server_rss_kb']} KB")
+    common.write_report(args.output, "load_replay", [entry], arguments=vars(args))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#A stand-in RDAP server for load tests. It answers /domain/<name> with a registration and expiration date after a
+#configurable delay.  Point rdap_url in domain_stats.yaml at it: rdap_url: http://127.0.0.1:8100
+#With --registries it starts that many stand-in registries on consecutive ports and serves an RDAP bootstrap file
+#that splits the TLDs between them at /dns.json. Point rdap_bootstrap_url at http://127.0.0.1:8100/dns.json.
+#--rate-limit makes each registry answer 429 with a Retry-After when it gets more lookups a second than that.
+#ISC mode needs no stub.  IscConnection.retrieve_isc builds its responses locally.
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import random
+import threading
+import time
+
+
+class StubRdapHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay_ms = 50
+    error_rate = 0.0
+    rate_limit = 0
+    bootstrap = None
+
+    def do_GET(self):
+        if self.path == "/dns.json" and self.bootstrap:
+            self.send_json(200, self.bootstrap)
+            return
+        if self.rate_limit and not self.server.take_token():
+            self.send_json(429, {"errorCode": 429, "title": "Too Many Requests"}, {"Retry-After": "1"})
+            return
+        domain = self.path.rstrip("/").rsplit("/", 1)[-1]
+        time.sleep(random.expovariate(1000 / self.delay_ms) if self.delay_ms else 0)
+        if not self.path.startswith("/domain/") or random.random() < self.error_rate:
+            self.send_json(404, {"errorCode": 404, "title": "Not Found"})
+            return
+        #The same domain always gets the same dates
+        age = int(hashlib.md5(domain.encode()).hexdigest()[:8], 16) % 5000
+        registered = datetime.datetime(2024, 1, 1) - datetime.timedelta(days=age)
+        expires = registered + datetime.timedelta(days=365 * (age // 365 + 2))
+        self.send_json(200, {"objectClassName": "domain", "ldhName": domain, "events": [
+            {"eventAction": "registration", "eventDate": registered.strftime("%Y-%m-%dT%H:%M:%SZ")},
+            {"eventAction": "expiration", "eventDate": expires.strftime("%Y-%m-%dT%H:%M:%SZ")}]})
+
+    def send_json(self, status, body, headers={}):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/rdap+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+class StubRdapServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler):
+        http.server.ThreadingHTTPServer.__init__(self, address, handler)
+        self.lock = threading.Lock()
+        self.window = int(time.time())
+        self.count = 0
+
+    def take_token(self):
+        #At most rate_limit lookups in each wall clock second
+        with self.lock:
+            now = int(time.time())
+            if now != self.window:
+                self.window, self.count = now, 0
+            self.count += 1
+            return self.count <= self.RequestHandlerClass.rate_limit
+
+
+def bootstrap_file(ports, tlds=("com", "net", "org", "info", "io", "xyz", "co.uk", "uk"), address="127.0.0.1"):
+    """An RDAP bootstrap file that gives each stand-in registry an equal share of tlds"""
+    return {"version": "1.0", "description": "domain_stats stub registries", "services": [
+        [list(tlds[pos::len(ports)]), [f"http://{address}:{port}/"]] for pos, port in enumerate(ports)]}
+
+def start(port=8100, delay_ms=50, error_rate=0.0, address="127.0.0.1", rate_limit=0, bootstrap=None):
+    """Start the stub in a daemon thread. Returns the server. Call shutdown() to stop it."""
+    handler = type("Handler", (StubRdapHandler,), {"delay_ms": delay_ms, "error_rate": error_rate, "rate_limit": rate_limit, "bootstrap": bootstrap})
+    server = StubRdapServer((address, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_registries(port=8100, registries=2, delay_ms=50, error_rate=0.0, address="127.0.0.1", rate_limit=0):
+    """Start registries stand-in registries on the ports after port and a server on port that answers /dns.json
+       with their bootstrap file and sends every lookup it gets the same answers. Returns the servers."""
+    ports = [port + 1 + pos for pos in range(registries)]
+    servers = [start(port, delay_ms, error_rate, address, bootstrap=bootstrap_file(ports, address=address))]
+    servers += [start(registry_port, delay_ms, error_rate, address, rate_limit) for registry_port in ports]
+    return servers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p','--port', type=int, default=8100, help='TCP port to listen on')
+    parser.add_argument('-d','--delay-ms', type=float, default=50, help='Mean response delay in milliseconds')
+    parser.add_argument('-e','--error-rate', type=float, default=0.0, help='Fraction of lookups answered with a 404')
+    parser.add_argument('-r','--registries', type=int, default=0, help='Also start this many stand-in registries on the following ports')
+    parser.add_argument('--rate-limit', type=int, default=0, help='Lookups a second each registry answers before it answers 429')
+    args = parser.parse_args()
+    if args.registries:
+        servers = start_registries(args.port, args.registries, args.delay_ms, args.error_rate, rate_limit=args.rate_limit)
+        print(f"Stub RDAP bootstrap file at http://127.0.0.1:{args.port}/dns.json for registries on ports {args.port + 1}-{args.port + args.registries}")
+    else:
+        servers = [start(args.port, args.delay_ms, args.error_rate, rate_limit=args.rate_limit)]
+        print(f"Stub RDAP server listening on http://127.0.0.1:{args.port}")
+    try:
+        while True: time.sleep(100)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
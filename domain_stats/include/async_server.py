@@ -0,0 +1,240 @@
+import asyncio
+import concurrent.futures
+import http
+import json
+import logging
+import socket
+import threading
+import urllib.parse
+
+log = logging.getLogger("domain_stats")
+
+
+class AsyncHttpServer(object):
+    """A small HTTP/1.1 server on an asyncio event loop with persistent connections and pipelining.
+       route(method, urlpath, body) is called on the event loop.  It returns a (status, content_type, body) tuple
+       when it can answer immediately or a function that returns that tuple. Functions are run in a bounded thread pool
+       so database and RDAP lookups never block the event loop.  Pipelined requests on a connection are dispatched
+       as soon as they are read and the responses are written back in request order."""
+
+    def __init__(self, server_address, route, workers=32, pipeline_depth=64, idle_timeout=300, max_body=16*1024*1024, backlog=4096, reuse_port=False):
+        self.server_address = server_address
+        self.route = route
+        self.pipeline_depth = pipeline_depth
+        self.idle_timeout = idle_timeout
+        self.max_body = max_body
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="async-worker")
+        #Limits the work waiting on the executor to a few requests per worker
+        self.queue_limit = workers * 4
+        #Bind now so errors are raised in the caller just like http.server.HTTPServer
+        self.socket = socket.create_server(server_address, backlog=backlog, reuse_port=reuse_port)
+        self.loop = None
+        self.stopping = None
+        #handler task -> its writer for every open connection
+        self.connections = {}
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.stopped.set()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.slots = asyncio.Semaphore(self.queue_limit)
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket)
+        async with server:
+            await self.stopping.wait()
+            #Closing idle keep-alive connections lets their handlers finish instead of being cancelled when the loop exits
+            for writer in self.connections.values():
+                writer.transport.abort()
+            if self.connections:
+                await asyncio.wait(list(self.connections), timeout=5)
+
+    def shutdown(self):
+        """Stop serve_forever from another thread and wait for it to exit"""
+        if self.loop and not self.stopped.is_set():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self.executor.shutdown(wait=False)
+
+    async def handle_connection(self, reader, writer):
+        self.connections[asyncio.current_task()] = writer
+        pending = asyncio.Queue(maxsize=self.pipeline_depth)
+        sender = asyncio.ensure_future(self.send_responses(pending, writer))
+        try:
+            while not sender.done():
+                try:
+                    request = await self.read_request(reader)
+                except ValueError as e:
+                    await pending.put((self.completed((400, "text/plain", str(e).encode())), False))
+                    break
+                if request is None:
+                    break
+                method, target, body, keep_alive = request
+                await pending.put((asyncio.ensure_future(self.dispatch(method, target, body)), keep_alive))
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if not sender.done():
+                await pending.put(None)
+            try:
+                await sender
+            except ConnectionError:
+                pass
+            writer.close()
+            del self.connections[asyncio.current_task()]
+
+    async def read_request(self, reader):
+        """Returns (method, target, body, keep_alive) or None when the client closes the connection"""
+        line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not line.strip():
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise ValueError("Bad request line")
+        method, target, version = parts
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length < 0 or length > self.max_body:
+            raise ValueError("Bad Content-Length")
+        body = await reader.readexactly(length) if length else b""
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            keep_alive = connection == "keep-alive"
+        else:
+            keep_alive = connection != "close"
+        return method, target, body, keep_alive
+
+    async def dispatch(self, method, target, body):
+        urlpath = urllib.parse.urlsplit(target).path
+        try:
+            result = self.route(method, urlpath, body)
+            if callable(result):
+                async with self.slots:
+                    result = await self.loop.run_in_executor(self.executor, result)
+        except Exception as e:
+            log.exception(f"Error handling {method} {urlpath}")
+            result = (500, "text/plain", f"Internal server error {str(e)}".encode())
+        return result
+
+    def completed(self, result):
+        future = self.loop.create_future()
+        future.set_result(result)
+        return future
+
+    async def send_responses(self, pending, writer):
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            future, keep_alive = item
+            status, content_type, body = await future
+            header = (f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+                      f"Content-Type: {content_type}\r\n"
+                      f"Content-Length: {len(body)}\r\n"
+                      f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+            writer.write(header.encode("latin-1") + body)
+            await writer.drain()
+            if not keep_alive:
+                return
+
+
+class AsyncStreamServer(AsyncHttpServer):
+    """A line protocol for pipelines that look up every event. Clients keep a connection open and send one request
+       per line: a domain, an id and a domain separated by whitespace or a json object with "id" and "domain".
+       Each result is sent back as one json line with the id and domain added to the object lookup returned.
+       Lines without an id are numbered from 1 on each connection.
+       lookup(domain) is called on the event loop.  It returns the json result when it can answer immediately or a
+       function that returns it. Functions are run in the thread pool and their results are sent as soon as they
+       are done so one slow lookup does not hold up the requests behind it."""
+
+    def __init__(self, server_address, lookup, workers=32, pipeline_depth=1024, idle_timeout=300, backlog=4096, reuse_port=False):
+        super().__init__(server_address, lookup, workers, pipeline_depth, idle_timeout, backlog=backlog, reuse_port=reuse_port)
+
+    async def handle_connection(self, reader, writer):
+        self.connections[asyncio.current_task()] = writer
+        #Lookups waiting on the thread pool for this connection. Reading stops while it is full.
+        in_flight = asyncio.Semaphore(self.pipeline_depth)
+        tasks = set()
+        line_number = 0
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                if not line:
+                    break
+                line_number += 1
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    request_id, domain = self.parse_request(line, line_number)
+                    result = self.route(domain)
+                except (ValueError, KeyError, TypeError) as e:
+                    writer.write(json.dumps({"id": line_number, "error": f"Bad request. {str(e)}"}).encode() + b"\n")
+                    continue
+                if callable(result):
+                    await in_flight.acquire()
+                    task = asyncio.ensure_future(self.resolve(request_id, domain, result, writer, in_flight))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    writer.write(self.tagged(request_id, domain, result))
+                await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            #ValueError is a line longer than the reader's limit
+            pass
+        finally:
+            #A client may send its requests and then shut down its side of the connection to wait for the results
+            if tasks:
+                await asyncio.wait(list(tasks))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+            del self.connections[asyncio.current_task()]
+
+    def parse_request(self, line, line_number):
+        """Returns (json encoded request id, domain)"""
+        if line.startswith(b"{"):
+            request = json.loads(line)
+            domain = request["domain"]
+            if not isinstance(domain, str):
+                raise TypeError("domain must be a string")
+            return json.dumps(request.get("id", line_number)).encode(), domain
+        parts = line.decode().split()
+        if len(parts) == 1:
+            return str(line_number).encode(), parts[0]
+        if len(parts) == 2:
+            return json.dumps(parts[0]).encode(), parts[1]
+        raise ValueError("Send a domain or an id and a domain on each line")
+
+    def tagged(self, request_id, domain, result):
+        #result is a json object. Splice the id and domain into it rather than decoding and encoding it again.
+        return b'{"id":' + request_id + b',"domain":' + json.dumps(domain).encode() + b"," + result.lstrip()[1:] + b"\n"
+
+    async def resolve(self, request_id, domain, function, writer, in_flight):
+        try:
+            async with self.slots:
+                result = await self.loop.run_in_executor(self.executor, function)
+        except Exception as e:
+            log.exception(f"Error resolving {domain}")
+            result = json.dumps({"error": f"Internal server error {str(e)}"}).encode()
+        finally:
+            in_flight.release()
+        if not writer.is_closing():
+            writer.write(self.tagged(request_id, domain, result))
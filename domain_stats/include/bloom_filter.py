@@ -0,0 +1,66 @@
+import math
+import threading
+
+
+class BloomFilter(object):
+    """A Bloom filter of strings. "key in filter" is False only if the key was never added.
+       It is sized for capacity keys at error_rate false positives. If that needs more than max_bytes the filter
+       is made max_bytes and the false positive rate goes up instead. The bit positions come from the key's
+       hash() so a filter is only meaningful inside the process (and its forks) that built it."""
+
+    def __init__(self, capacity, error_rate=0.01, max_bytes=None):
+        capacity = max(capacity, 1)
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        if max_bytes:
+            size = min(size, max_bytes * 8)
+        #The double hashing below uses 32 bit halves of the hash
+        self.size = min(max(size, 64), 2 ** 32)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        #Setting a bit is a read-modify-write of its byte so concurrent adds must not interleave
+        self.lock = threading.Lock()
+
+    def _positions(self, key):
+        hashed = hash(key)
+        first, step = hashed & 0xFFFFFFFF, ((hashed >> 32) & 0xFFFFFFFF) | 1
+        size = self.size
+        return [(first + i * step) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        with self.lock:
+            for position in self._positions(key):
+                bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def update(self, keys):
+        #_positions() inlined. This adds every domain in the database at startup.
+        bits, size, hashes = self.bits, self.size, range(self.hashes)
+        with self.lock:
+            for key in keys:
+                hashed = hash(key)
+                position, step = hashed & 0xFFFFFFFF, ((hashed >> 32) & 0xFFFFFFFF) | 1
+                for _ in hashes:
+                    position %= size
+                    bits[position >> 3] |= 1 << (position & 7)
+                    position += step
+                self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def error_rate(self):
+        """Expected false positive rate for the number of keys added so far"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def __repr__(self):
+        return f"BloomFilter(keys={self.count}, bytes={len(self.bits)}, hashes={self.hashes}, error_rate={self.error_rate():.4f})"
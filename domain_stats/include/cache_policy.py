@@ -0,0 +1,162 @@
+import collections
+import math
+
+#Eviction policies for ExpiringCache. The cache keeps its entries in a dict and tells the policy about every
+#insert, hit, miss and removal of an entry that can page out. Permanent (-2) entries are never given to the policy
+#so they are never evicted.  When the cache is over maxsize it asks victim() for a key, which the policy forgets,
+#and deletes it.
+
+
+class LruPolicy(object):
+    """Evicts the least recently used entry. The cache's OrderedDict is kept in LRU order so there is no other state."""
+    name = "lru"
+    #Memory each entry costs the policy beyond what the cache itself uses
+    entry_bytes = 0
+
+    def __init__(self, entries, maxsize):
+        self.entries = entries
+        #A hit is a C call with no policy code in between
+        self.record_hit = entries.move_to_end
+
+    def record_insert(self, key):
+        pass
+
+    def record_miss(self, key):
+        pass
+
+    def record_remove(self, key):
+        pass
+
+    def victim(self):
+        for key in self.entries:
+            return key
+        return None
+
+    def clear(self):
+        pass
+
+
+class FrequencySketch(object):
+    """A count-min sketch of how often each key was requested recently. Counters saturate at 15 and every counter is
+       halved after sample_size increments so keys that stop being requested lose their frequency."""
+    HALVE = bytes(count >> 1 for count in range(256))
+
+    def __init__(self, maxsize, depth=4):
+        self.width = 1 << max(6, math.ceil(math.log2(max(maxsize, 1))))
+        self.mask = self.width - 1
+        self.rows = range(0, depth * self.width, self.width)
+        self.table = bytearray(depth * self.width)
+        self.sample_size = 10 * max(maxsize, 1)
+        self.additions = 0
+
+    def increment(self, key):
+        #A counter in each row picked by double hashing like BloomFilter
+        hashed = hash(key)
+        position, step = hashed & 0xFFFFFFFF, ((hashed >> 32) & 0xFFFFFFFF) | 1
+        table, mask = self.table, self.mask
+        for row in self.rows:
+            index = row + (position & mask)
+            if table[index] < 15:
+                table[index] += 1
+            position += step
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.table = table.translate(self.HALVE)
+            self.additions //= 2
+
+    def frequency(self, key):
+        hashed = hash(key)
+        position, step = hashed & 0xFFFFFFFF, ((hashed >> 32) & 0xFFFFFFFF) | 1
+        table, mask = self.table, self.mask
+        count = 15
+        for row in self.rows:
+            count = min(count, table[row + (position & mask)])
+            position += step
+        return count
+
+    def clear(self):
+        self.table = bytearray(len(self.table))
+        self.additions = 0
+
+
+class TinyLfuPolicy(object):
+    """W-TinyLFU. New entries go to a small LRU window. The entry that falls out of the window only stays in the main
+       area if it was requested more often than the entry the main area would evict, so a scan of one off domains
+       can not push out the popular ones. The main area is a segmented LRU: entries start in probation and a hit
+       moves them to protected, which is 80% of the main area."""
+    name = "tinylfu"
+    #Each entry is also in one of the segments
+    entry_bytes = 96
+
+    def __init__(self, entries, maxsize, window_percent=1, protected_percent=80):
+        self.sketch = FrequencySketch(maxsize)
+        self.window_max = max(1, maxsize * window_percent // 100)
+        self.protected_max = max(1, (maxsize - self.window_max) * protected_percent // 100)
+        self.window = collections.OrderedDict()
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        #The last key moved from the window to probation. It has to beat the probation LRU to stay.
+        self.candidate = None
+
+    def record_insert(self, key):
+        #The lookup that missed before the insert already counted it
+        self.window[key] = None
+        self.candidate = None
+        if len(self.window) > self.window_max:
+            self.candidate, _ = self.window.popitem(last=False)
+            self.probation[self.candidate] = None
+
+    def record_hit(self, key):
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+        elif key in self.probation:
+            del self.probation[key]
+            self.protected[key] = None
+            if len(self.protected) > self.protected_max:
+                demoted, _ = self.protected.popitem(last=False)
+                self.probation[demoted] = None
+        else:
+            self.protected.move_to_end(key)
+
+    def record_miss(self, key):
+        self.sketch.increment(key)
+
+    def record_remove(self, key):
+        for segment in (self.window, self.probation, self.protected):
+            if segment.pop(key, 0) is None:
+                return
+
+    def victim(self):
+        candidate, self.candidate = self.candidate, None
+        if candidate is not None and candidate in self.probation:
+            segment = self.probation
+            victim = next(iter(segment))
+            if victim == candidate and self.protected:
+                segment = self.protected
+                victim = next(iter(segment))
+            #Ties go to the entry already in the cache
+            if victim != candidate and self.sketch.frequency(candidate) <= self.sketch.frequency(victim):
+                segment, victim = self.probation, candidate
+            del segment[victim]
+            return victim
+        for segment in (self.probation, self.protected, self.window):
+            if segment:
+                return segment.popitem(last=False)[0]
+        return None
+
+    def clear(self):
+        self.window.clear()
+        self.probation.clear()
+        self.protected.clear()
+        self.candidate = None
+        self.sketch.clear()
+
+
+POLICIES = {policy.name: policy for policy in (LruPolicy, TinyLfuPolicy)}
+
+def create(name, entries, maxsize):
+    """The policy called name for a cache that keeps its pageable entries in the OrderedDict entries"""
+    if name not in POLICIES:
+        raise ValueError(f"Unknown cache policy {name}. Choose one of {', '.join(POLICIES)}.")
+    return POLICIES[name](entries, maxsize)
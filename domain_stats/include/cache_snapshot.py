@@ -0,0 +1,115 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import logging
+
+log = logging.getLogger("domain_stats")
+
+#A snapshot is a header followed by one record per cache entry in LRU order (least recently used first).
+#  header: magic, format version, reserved, entry count, time.time() it was written
+#  entry:  expires (time.time() second or a negative hours_to_live), read count, key length, data type, data length, key, data
+#Keys are utf-8 strings. Data is bytes or a utf-8 string. Nothing in the file is executed when it is loaded.
+MAGIC = b"DSCACHE\x00"
+VERSION = 1
+HEADER = struct.Struct("<8sHHQd")
+ENTRY = struct.Struct("<dIHBI")
+DATA_BYTES, DATA_STR = 0, 1
+
+write_lock = threading.Lock()
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write(fname, entries):
+    """Write (key, expires, read_count, data) entries to fname. The file is replaced atomically so a crash
+       while writing leaves the previous snapshot intact. Returns the number of entries written."""
+    count = 0
+    with write_lock:
+        tmp = f"{fname}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(HEADER.pack(MAGIC, VERSION, 0, 0, time.time()))
+            for key, expires, read_count, data in entries:
+                key = key.encode()
+                if isinstance(data, str):
+                    data, data_type = data.encode(), DATA_STR
+                else:
+                    data_type = DATA_BYTES
+                fh.write(ENTRY.pack(expires, min(read_count, 0xFFFFFFFF), len(key), data_type, len(data)))
+                fh.write(key)
+                fh.write(data)
+                count += 1
+            fh.seek(0)
+            fh.write(HEADER.pack(MAGIC, VERSION, 0, count, time.time()))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, fname)
+    return count
+
+def header(fname):
+    """Returns (version, entry count, time written) or raises SnapshotError if fname is not a snapshot this code can read"""
+    with open(fname, "rb") as fh:
+        data = fh.read(HEADER.size)
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError(f"{fname} is not a cache snapshot")
+    _, version, _, count, written = HEADER.unpack(data)
+    if version != VERSION:
+        raise SnapshotError(f"{fname} is snapshot version {version}. Version {VERSION} is supported.")
+    return version, count, written
+
+def read(fname, batch_size=10000):
+    """Yield lists of up to batch_size (key, expires, read_count, data) entries from a snapshot.
+       The file is memory mapped and decoded a batch at a time."""
+    _, count, _ = header(fname)
+    with open(fname, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            offset = HEADER.size
+            batch = []
+            for _ in range(count):
+                if offset + ENTRY.size > size:
+                    log.info(f"Cache snapshot {fname} is truncated")
+                    break
+                expires, read_count, key_len, data_type, data_len = ENTRY.unpack_from(view, offset)
+                offset += ENTRY.size
+                end = offset + key_len + data_len
+                if end > size:
+                    log.info(f"Cache snapshot {fname} is truncated")
+                    break
+                key = view[offset:offset + key_len].decode()
+                data = view[offset + key_len:end]
+                if data_type == DATA_STR:
+                    data = data.decode()
+                batch.append((key, expires, read_count, data))
+                offset = end
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+def load(cache, fname, batch_size=10000):
+    """Insert the snapshot into cache one batch at a time. Returns the number of entries read."""
+    start = time.perf_counter()
+    count = 0
+    for batch in read(fname, batch_size):
+        cache.load_entries(batch)
+        count += len(batch)
+    log.info(f"Loaded {count} entries from cache snapshot {fname} in {time.perf_counter() - start:.2f} seconds")
+    return count
+
+def load_in_background(cache, fname, batch_size=10000):
+    """Load the snapshot on a daemon thread so the server can take requests while the cache is rehydrated.
+       The header is checked before the thread starts so a bad file raises SnapshotError in the caller."""
+    header(fname)
+    def run():
+        try:
+            load(cache, fname, batch_size)
+        except (OSError, SnapshotError) as e:
+            log.info(f"Unable to load cache snapshot. {str(e)}")
+    thread = threading.Thread(target=run, name="cache-load", daemon=True)
+    thread.start()
+    return thread
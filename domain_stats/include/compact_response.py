@@ -0,0 +1,59 @@
+import datetime
+import json
+import struct
+import time
+import include.schema as schema
+
+#Responses are kept in the memory cache packed into a few bytes and rendered as JSON when they are served.
+#  header: format, seen_by_web kind, seen_by_isc kind, seen_by_you kind, category, seen_by_web, seen_by_isc, seen_by_you
+#  alerts: the alert strings utf-8 encoded and separated by NUL bytes
+#A kind of DATE means the field is uint32 seconds since the epoch. Any other kind is the string TEXT[kind] and the
+#field is 0. The strings are a fixed table rather than interned as they are seen so a packed response means the same
+#thing in every process, in a cache snapshot and in the shared cache.  JSON starts with "{" so it is never mistaken
+#for a packed response and caches holding JSON from an older version still work.
+FORMAT = 1
+HEADER = struct.Struct("<BBBBBIII")
+DATE = 0
+TEXT = ("", "ERROR", "LOCAL", "RDAP", "NEW", "ESTABLISHED")
+CODES = {text: kind for kind, text in enumerate(TEXT) if text}
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _field(value):
+    if isinstance(value, datetime.datetime):
+        #The JSON shows the date as it is. Only UTC can be rebuilt from the seconds.
+        if value.utcoffset():
+            raise ValueError("Only UTC dates can be packed")
+        return DATE, schema.to_epoch(value)
+    if value not in CODES:
+        raise ValueError(f"{value} can not be packed")
+    return CODES[value], 0
+
+def pack(web, isc, you, category, alerts):
+    """The packed form of the response json_response() would build from the same arguments.
+       Raises ValueError if it can't be packed and the JSON should be cached instead."""
+    if category not in CODES:
+        raise ValueError(f"{category} can not be packed")
+    if not all(isinstance(alert, str) and alert and "\0" not in alert for alert in alerts):
+        raise ValueError("Alerts must be strings to be packed")
+    (web_kind, web), (isc_kind, isc), (you_kind, you) = _field(web), _field(isc), _field(you)
+    try:
+        header = HEADER.pack(FORMAT, web_kind, isc_kind, you_kind, CODES[category], web, isc, you)
+    except struct.error:
+        raise ValueError("Date is out of range")
+    return header + "\0".join(alerts).encode()
+
+def _text(kind, value):
+    if kind == DATE:
+        return time.strftime(DATE_FORMAT, time.gmtime(value))
+    return TEXT[kind]
+
+def render(data):
+    """The JSON response for cached data. Data that isn't packed is already JSON and is returned as it is."""
+    if data[:1] != b"\x01":
+        return data
+    _, web_kind, isc_kind, you_kind, category, web, isc, you = HEADER.unpack_from(data)
+    alerts = json.dumps(data[HEADER.size:].decode().split("\0")) if len(data) > HEADER.size else "[]"
+    #The same text json.dumps() makes of the dict in json_response()
+    return (f'{{"seen_by_web": "{_text(web_kind, web)}", "seen_by_isc": "{_text(isc_kind, isc)}", '
+            f'"seen_by_you": "{_text(you_kind, you)}", "category": "{TEXT[category]}", "alerts": {alerts}}}').encode()
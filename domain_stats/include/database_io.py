@@ -3,182 +3,698 @@ import threading
 import datetime
 import logging
 import pathlib
-import urllib
+import queue
+import contextlib
+import itertools
+import operator
+import time
+import urllib.parse
+import urllib.request
+import concurrent.futures
+import os
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import include.write_behind as write_behind
+import include.expiry_sweeper as expiry_sweeper
+import include.public_suffix as public_suffix
+import include.bloom_filter as bloom_filter
+import include.domain_index as domain_index
+import include.schema as schema
 
 log = logging.getLogger("domain_stats")
 
   
 class database_stats:
-    def __init__(self, hit=0,miss=0, insert=0, delete=0) :
+    def __init__(self, hit=0,miss=0, insert=0, delete=0, opened=0, reused=0) :
         self.hit = hit
         self.miss = miss
         self.insert = insert
         self.delete = delete
+        #Connection pool counters. opened is new sqlite connections, reused is checkouts served by an idle connection
+        self.opened = opened
+        self.reused = reused
+        self.idle = 0
+        #Write behind counters. write_queue is the current queue depth, write_rows/write_batches is the average batch size
+        self.write_queue = 0
+        self.write_batches = 0
+        self.write_rows = 0
+        self.write_max_batch = 0
+        #Bloom filter counters. bloom_skip lookups were answered without a query, bloom_false queries found nothing.
+        self.bloom_hit = 0
+        self.bloom_skip = 0
+        self.bloom_false = 0
+        #Expired rows deleted by the background sweeper. delete counts the rest.
+        self.sweep = 0
+        #Lookups answered by the compiled domain index without a query
+        self.index_hit = 0
 
     def __repr__(self):
-        return f"database_stats(hit={self.hit},miss={self.miss},insert={self.insert},delete={self.delete})"
-
-def reduce_domain(domain_in):
-    parts =  domain_in.strip().split(".")
-    if len(parts)> 2: 
-        if parts[-1] not in ['com','org','net','gov','edu']:
-            if parts[-2] in ['co', 'com','ne','net','or','org','go','gov','ed','edu','ac','ad','gr','lg','mus','gouv']:
-                domain = ".".join(parts[-3:])
-            else:
-                domain = ".".join(parts[-2:])
-        else:
-            domain = ".".join(parts[-2:])
-            #print("trim top part", domain_in, domain)
-    else:
-        domain = ".".join(parts)
-    return domain.lower()
+        return (f"database_stats(hit={self.hit},miss={self.miss},insert={self.insert},delete={self.delete},"
+                f"pool_opened={self.opened},pool_reused={self.reused},pool_idle={self.idle},"
+                f"write_queue={self.write_queue},write_batches={self.write_batches},write_rows={self.write_rows},write_max_batch={self.write_max_batch},"
+                f"bloom_hit={self.bloom_hit},bloom_skip={self.bloom_skip},bloom_false={self.bloom_false},sweep={self.sweep},index_hit={self.index_hit})")
 
 class DomainStatsDatabase(object):
 
-    def __init__(self, filename):
+    def __init__(self, filename, pool_size=16, cache_kb=16384, mmap_mb=256, read_only=False):
         self.filename = filename
+        #A read only database opens its connections with mode=ro and ignores writes, including first contacts
+        self.read_only = read_only
         self.lock = threading.Lock()
         self.stats = database_stats()
+        #Idle connections are kept in a LIFO so the most recently used (warmest) connection is handed out first
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.pid = os.getpid()
+        self.cache_kb = cache_kb
+        self.mmap_mb = mmap_mb
+        self.writer = None
+        self.sweeper = None
+        #Lookups delete the expired registrations they find unless an expiry sweeper deletes them
+        self.delete_expired = True
+        #Set by start_bloom_filter. Lookups only trust it once bloom_ready is set.
+        self.bloom = None
+        self.bloom_ready = False
+        #Set by open_index. Dropped when this process changes the established domains or, when it is next checked,
+        #if another process has.
+        self.index = None
+        self.index_check_seconds = 10
+        self.index_next_check = 0
+        self._set_schema(schema.LATEST)
         if not pathlib.Path(self.filename).exists():
             print(f"WARNING: Database not found. {self.filename}")
             return
-        db = sqlite3.connect(filename, timeout=15)
-        cursor = db.cursor()
-        self.version,self.created,self.lastupdate = cursor.execute("select version,created,lastupdate from info").fetchone()
+        with self.connection() as db:
+            self.version,self.created,self.lastupdate = db.execute("select version,created,lastupdate from info").fetchone()
+            self._set_schema(schema.version(db))
+
+    def _set_schema(self, version):
+        #Reads and writes use the SQL for the schema version of the open database
+        self.schema = version
+        self.write_sql = schema.WRITE_SQL[version]
+        self.select_sql = f"select {schema.COLUMNS[version]} from domains where domain = ?"
+        self.select_many_sql = f"select domain, {schema.COLUMNS[version]} from domains where domain in "
+
+    def _connect(self):
+        if self.read_only:
+            uri = f"{pathlib.Path(self.filename).resolve().as_uri()}?mode=ro"
+            db = sqlite3.connect(uri, uri=True, timeout=15, check_same_thread=False, cached_statements=256)
+        else:
+            db = sqlite3.connect(self.filename, timeout=15, check_same_thread=False, cached_statements=256)
+            #WAL lets readers continue while a writer commits. NORMAL sync is durable in WAL mode except on power loss.
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(f"PRAGMA cache_size=-{int(self.cache_kb)}")
+        db.execute(f"PRAGMA mmap_size={int(self.mmap_mb) * 1024 * 1024}")
+        self.stats.opened += 1
+        return db
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check a connection out of the pool for the duration of the with block"""
+        if os.getpid() != self.pid:
+            #Connections must not cross a fork. Forget the parent's and open new ones in this process.
+            self.pool = queue.LifoQueue(maxsize=self.pool.maxsize)
+            self.pid = os.getpid()
+        try:
+            db = self.pool.get_nowait()
+            self.stats.reused += 1
+        except queue.Empty:
+            db = self._connect()
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                db.rollback()
+            try:
+                self.pool.put_nowait(db)
+            except queue.Full:
+                db.close()
+            self.stats.idle = self.pool.qsize()
+
+    def start_write_behind(self, interval_ms=250, max_rows=1000):
+        """Queue writes to a background writer that group commits them instead of committing on the request thread"""
+        self.writer = write_behind.WriteBehindQueue(self, interval_ms, max_rows)
+
+    def flush(self):
+        """Wait for any queued writes to be committed"""
+        if self.writer:
+            self.writer.flush()
+
+    def start_sweeper(self, interval_minutes=60, batch_rows=500, pause_ms=100, vacuum_pages=1000):
+        """Delete expired registrations on a background thread in small batches instead of when lookups find them"""
+        self.delete_expired = False
+        self.sweeper = expiry_sweeper.ExpirySweeper(self, interval_minutes, batch_rows, pause_ms, vacuum_pages)
+
+    def create_expires_index(self):
+        with self.connection() as db, self.lock:
+            db.execute(schema.EXPIRES_INDEX_SQL)
+            db.commit()
+
+    def sweep_expired(self, limit=500):
+        """Delete up to limit domains whose registration has expired. Returns the number deleted."""
+        if self.schema >= 2:
+            now = int(time.time())
+        else:
+            now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        with self.connection() as db, self.lock:
+            deleted = db.execute(self.write_sql["sweep"], (now, limit)).rowcount
+            db.commit()
+        self.stats.sweep += deleted
+        return deleted
+
+    def maintain(self, vacuum_pages=1000):
+        """Return free pages to the file system if the database uses incremental auto_vacuum and refresh the
+           query planner statistics"""
+        with self.connection() as db, self.lock:
+            if vacuum_pages and db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                #execute() stops after the first page is freed. executescript() runs the pragma to completion.
+                db.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)});")
+            db.execute("PRAGMA optimize")
+
+    def start_bloom_filter(self, error_rate=0.01, max_mb=64, headroom=0.25):
+        """Build a Bloom filter of every domain on a background thread. Once it is built, lookups for domains
+           that are not in it skip the database.  Domains added through this object are added to the filter.
+           Deleted domains stay in it, which only costs a query."""
+        self.bloom_args = (error_rate, max_mb, headroom)
+        with self.connection() as db:
+            rows = db.execute("select count(*) from domains").fetchone()[0]
+        self.bloom_ready = False
+        self.bloom = bloom_filter.BloomFilter(int(rows * (1 + headroom)) + 10000, error_rate, int(max_mb * 1024 * 1024))
+        thread = threading.Thread(target=self._build_bloom_filter, name="bloom-filter", daemon=True)
+        thread.start()
+        return thread
 
-    def create_file(self, filename):
+    def _build_bloom_filter(self):
+        start = time.perf_counter()
+        with self.connection() as db:
+            cursor = db.execute("select domain from domains")
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                self.bloom.update(row[0] for row in rows)
+        self.bloom_ready = True
+        log.info(f"Built {self.bloom} in {time.perf_counter() - start:.2f} seconds")
+
+    def open_index(self, filename, check_seconds=10):
+        """Answer lookups from a domain index compiled by compile_index. It is only used if it was compiled from
+           this version of the database and every check_seconds a lookup checks that it still is. Returns True if
+           the index is in use."""
+        try:
+            index = domain_index.DomainIndex(filename)
+        except (OSError, domain_index.DomainIndexError) as e:
+            log.info(f"Unable to open the domain index. {str(e)}")
+            return False
+        if not index.matches(self.version, self.lastupdate):
+            log.info(f"{index} is out of date. The database is version {self.version} updated {self.lastupdate}. Recompile it with database_admin --compile.")
+            index.close()
+            return False
+        self.index_check_seconds = check_seconds
+        self.index_next_check = time.monotonic() + check_seconds
+        self.index = index
+        log.info(f"Using {index}")
+        return True
+
+    def check_index(self):
+        """Drop the domain index if the database was changed since it was compiled. Changes made by other processes,
+           such as another server worker or database_admin, are only seen here. Returns True if the index is in use."""
+        index = self.index
+        if not index:
+            return False
+        with self.connection() as db:
+            self.version, self.lastupdate = db.execute("select version,lastupdate from info").fetchone()
+        if not index.matches(self.version, self.lastupdate):
+            self._drop_index(f"The database was changed at {self.lastupdate}.")
+            return False
+        return True
+
+    def compile_index(self, filename):
+        """Write the domains table to a domain index. Returns the number of domains in it."""
+        self.flush()
+        with self.connection() as db:
+            return domain_index.write(db, filename, self.version, self.lastupdate, self.schema)
+
+    def _drop_index(self, reason):
+        #Lookups in flight keep their reference to the map. It is unmapped when the last one finishes.
+        if self.index:
+            log.info(f"No longer using the domain index. {reason}")
+            self.index = None
+
+    def _touch_lastupdate(self, db):
+        #Any index compiled before this change no longer matches the database
+        self.lastupdate = datetime.datetime.utcnow()
+        db.execute("update info set lastupdate=?", (self.lastupdate,))
+
+    def _write(self, op, domain, params, row=None):
+        if self.read_only:
+            return
+        if self.bloom and op == "replace":
+            self.bloom.add(domain)
+        if self.writer and self.writer.put(op, domain, params, row):
+            return
+        with self.connection() as db, self.lock:
+            db.execute(self.write_sql[op], params)
+            db.commit()
+            if op == "replace":
+                self.stats.insert += 1
+            elif op == "delete":
+                self.stats.delete += 1
+
+    def close(self):
+        """Stop the sweeper, commit queued writes and close all of the idle connections in the pool"""
+        if self.sweeper:
+            self.sweeper.close()
+            self.sweeper = None
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        self._close_idle()
+
+    def _close_idle(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self.stats.idle = 0
+
+    def create_file(self, filename, schema_version=schema.LATEST):
         datab = sqlite3.connect(filename)
         cursor = datab.cursor()
-        cursor.execute("CREATE TABLE domains (domain text NOT NULL UNIQUE,seen_by_web timestamp not NULL,expires timestamp not NULL,seen_by_isc timestamp not NULL,seen_by_you timestamp not NULL)")
-        cursor.execute("CREATE TABLE info (version real NOT NULL,created timestamp not NULL,lastupdate timestamp not NULL)")
-        new_info = (1.0, datetime.datetime.utcnow(), datetime.datetime.utcnow())
+        #Lets the sweeper give the space of the rows it deletes back to the file system. It must be set before any table is created.
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.execute(schema.CREATE_SQL[schema_version])
+        cursor.execute(schema.EXPIRES_INDEX_SQL)
+        cursor.execute(schema.INFO_SQL)
+        new_info = ("1.0", datetime.datetime.utcnow(), datetime.datetime.utcnow())
         cursor.execute("insert into info (version, created, lastupdate) values (?,?,?)", new_info)
+        cursor.execute(f"PRAGMA user_version={int(schema_version)}")
         datab.commit()
+        datab.close()
         self.version, self.created, self.last_update = new_info
+        self._set_schema(schema_version)
+
+    def migrate(self):
+        """Convert a version 1 database to the latest schema in place. Returns the number of rows converted."""
+        if self.schema >= schema.LATEST:
+            return 0
+        self.flush()
+        self._drop_index("The database schema is being migrated.")
+        start = time.perf_counter()
+        #Pooled connections have statements for the old table cached
+        self._close_idle()
+        #A running server would keep writing in the old format
+        if self.opened_elsewhere():
+            raise Exception(f"{self.filename} is open in another process. Stop the domain_stats server before migrating.")
+        with self.connection() as db, self.lock:
+            db.execute("BEGIN")
+            for sql in schema.MIGRATE_SQL:
+                db.execute(sql)
+            rows = db.execute("select count(*) from domains").fetchone()[0]
+            self._touch_lastupdate(db)
+            db.commit()
+            self._set_schema(schema.version(db))
+            #Give the space used by the text columns back to the file system. VACUUM also applies the auto_vacuum mode.
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            db.execute("VACUUM")
+        log.info(f"Migrated {rows} domains to schema version {self.schema} in {time.perf_counter() - start:.2f} seconds")
+        return rows
+
+    def opened_elsewhere(self):
+        """True if another process has the database open. Every process with a WAL database open holds a shared lock
+           on byte 128 of its -shm file. Call it with no connection of this process open: closing the -shm file
+           drops every lock this process holds on it. Always False without fcntl."""
+        if not fcntl:
+            return False
+        try:
+            fh = open(f"{self.filename}-shm", "rb+")
+        except OSError:
+            return False
+        with fh:
+            try:
+                fcntl.lockf(fh, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, 128)
+            except OSError:
+                return True
+            fcntl.lockf(fh, fcntl.LOCK_UN, 1, 128)
+        return False
 
     def reset_first_contact(self):
-        db= sqlite3.connect(self.filename)
         log.info("Database_admin was used to reset all of the seen_by_you dates to FIRST-CONTACT")
         print(f"Resetting all seen_by_you dates to FIRST-CONTACT.")
-        cursor = db.cursor()
-        cursor.execute("update domains set seen_by_you=?", ("FIRST-CONTACT",))
-        db.commit() 
+        self.flush()
+        with self.connection() as db, self.lock:
+            db.execute(self.write_sql["reset"])
+            self._touch_lastupdate(db)
+            db.commit()
+        self._drop_index("The seen_by_you dates were reset.")
         print(f"RESET! You probably want to also delete your .cache file at this time.")
 
     def update_record(self, domain, record_seen_by_web, record_expires, record_seen_by_isc, record_seen_by_you):
+        if self.schema >= 2:
+            flags = 0
+            if record_seen_by_isc == "LOCAL":
+                record_seen_by_isc, flags = 0, schema.ISC_LOCAL
+            elif record_seen_by_isc == "RDAP":
+                record_seen_by_isc, flags = 0, schema.ISC_RDAP
+            else:
+                record_seen_by_isc = schema.to_epoch(record_seen_by_isc)
+            if record_seen_by_you == "FIRST-CONTACT":
+                record_seen_by_you, flags = 0, flags | schema.FIRST_CONTACT
+            else:
+                record_seen_by_you = schema.to_epoch(record_seen_by_you)
+            row = (schema.to_epoch(record_seen_by_web), schema.to_epoch(record_expires), record_seen_by_isc, record_seen_by_you, flags)
+            log.info("Writing to database %s %s %s", self.filename, domain, row)
+            self._write("replace", domain, (domain,) + row, row)
+            return 1
         record_seen_by_web = record_seen_by_web.strftime('%Y-%m-%d %H:%M:%S')
         record_expires = record_expires.strftime('%Y-%m-%d %H:%M:%S')
         if record_seen_by_isc != "LOCAL" and record_seen_by_isc != "RDAP":
             record_seen_by_isc = record_seen_by_isc.strftime('%Y-%m-%d %H:%M:%S')
         if record_seen_by_you != "FIRST-CONTACT":
             record_seen_by_you = record_seen_by_you.strftime('%Y-%m-%d %H:%M:%S')
-        db = sqlite3.connect(self.filename, timeout=15)
-        cursor = db.cursor()
-        log.info("Writing to database {} {} {} {} {} {}".format(self.filename, domain, record_seen_by_web, record_expires, record_seen_by_isc, record_seen_by_you))
-        sql = "insert or replace into domains (domain, seen_by_web,expires,seen_by_isc,seen_by_you) values (?,?,?,?,?)"
-        with self.lock:
-            cursor.execute(sql, (domain, record_seen_by_web, record_expires, record_seen_by_isc, record_seen_by_you))
-            db.commit()
-            self.stats.insert += 1
+        log.info("Writing to database %s %s %s %s %s %s", self.filename, domain, record_seen_by_web, record_expires, record_seen_by_isc, record_seen_by_you)
+        row = (record_seen_by_web, record_expires, record_seen_by_isc, record_seen_by_you)
+        self._write("replace", domain, (domain,) + row, row)
         return 1
 
     def delete_record(self, domain):
-        log.info("Deleting record from database for {}".format(domain))
-        db = sqlite3.connect(self.filename, timeout=15)
-        cursor = db.cursor()
-        with self.lock:
-            cursor.execute("delete from domains where domain=?", (domain,))
-            db.commit()
-            self.stats.delete += 1
+        log.info("Deleting record from database for %s", domain)
+        self._write("delete", domain, (domain,))
         return 1
 
-    def get_record(self, domain):
-        #Pass the timezone offset  hardcoded to utc for now
+    def get_record(self, domain, peek=False):
         #If record not found returns None,None,None,None
         #If record found rturns dates seen by web,expired,isc and you
-        #If record is in database but domain registration expired it deletes the record and ignores it.
-        timezone_offset = 0
-        db = sqlite3.connect(self.filename, timeout=15)
-        cursor = db.cursor()
-        record = cursor.execute("select seen_by_web,expires, seen_by_isc, seen_by_you from domains where domain = ?" , (domain,) ).fetchone()
-        if record:
-            web,expires,isc,you = record
+        #If record is in database but domain registration expired it is deleted and ignored. With an expiry sweeper it is only ignored.
+        #A peek reports FIRST-CONTACT without recording the contact so a background lookup doesn't use it up.
+        found, record = self.writer.lookup(domain) if self.writer else (False, None)
+        if not found and self.index:
+            indexed = self._index_record(domain)
+            if indexed:
+                return indexed
+        if not found:
+            if self.bloom_ready:
+                if domain not in self.bloom:
+                    self.stats.bloom_skip += 1
+                    return self._decode_record(domain, None, peek)
+                self.stats.bloom_hit += 1
+            with self.connection() as db:
+                record = db.execute(self.select_sql, (domain,)).fetchone()
+            if not record and self.bloom_ready:
+                self.stats.bloom_false += 1
+        return self._decode_record(domain, record, peek)
+
+    def get_records(self, domains, chunk_size=500):
+        """get_record for many domains using one "where domain in (...)" query per chunk_size domains"""
+        """Returns a dictionary of domain to the (web,expires,isc,you) tuple that get_record would return"""
+        records = {}
+        indexed = {}
+        remaining = []
+        domains = list(dict.fromkeys(domains))
+        for domain in domains:
+            found, record = self.writer.lookup(domain) if self.writer else (False, None)
+            if found:
+                records[domain] = record
+                continue
+            record = self._index_record(domain) if self.index else None
+            if record:
+                indexed[domain] = record
+            elif self.bloom_ready and domain not in self.bloom:
+                self.stats.bloom_skip += 1
+            else:
+                remaining.append(domain)
+        with self.connection() as db:
+            for pos in range(0, len(remaining), chunk_size):
+                chunk = remaining[pos:pos+chunk_size]
+                sql = f"{self.select_many_sql}({','.join('?'*len(chunk))})"
+                for domain, *record in db.execute(sql, chunk):
+                    records[domain] = record
+        if self.bloom_ready:
+            self.stats.bloom_hit += len(remaining)
+            self.stats.bloom_false += sum(1 for domain in remaining if domain not in records)
+        return {domain:indexed[domain] if domain in indexed else self._decode_record(domain, records.get(domain)) for domain in domains}
+
+    def _index_record(self, domain):
+        #Returns the decoded record if the index can answer for domain. A domain the index doesn't have, an expired
+        #registration or a FIRST-CONTACT that may since have been seen locally is left to the database.
+        if time.monotonic() >= self.index_next_check:
+            self.index_next_check = time.monotonic() + self.index_check_seconds
+            if not self.check_index():
+                return None
+        index = self.index
+        record = index.get(domain) if index else None
+        if not record:
+            return None
+        web, expires, isc, you = record
+        if you == domain_index.UNSET or expires < time.time():
+            return None
+        record = (schema.from_epoch(web), schema.from_epoch(expires),
+                  "LOCAL" if isc == domain_index.UNSET else schema.from_epoch(isc), schema.from_epoch(you))
+        self.stats.hit += 1
+        self.stats.index_hit += 1
+        return record
+
+    def _expired(self, domain, expires, peek):
+        if self.delete_expired and not peek:
+            log.info("Expired domain in database %s %s. Deleted", domain, expires)
+            self._write("delete", domain, (domain,))
         else:
+            log.info("Expired domain in database %s %s. Ignored", domain, expires)
+
+    def _decode_record(self, domain, record, peek=False):
+        #Pass the timezone offset  hardcoded to utc for now
+        timezone_offset = 0
+        if not record:
             self.stats.miss += 1
             log.info("No record in the database.  Returning None.")
             return (None,None,None,None)
+        if self.schema >= 2:
+            return self._decode_epoch_record(domain, record, peek)
+        web,expires,isc,you = record
         web = datetime.datetime.strptime(web, '%Y-%m-%d %H:%M:%S')
         expires = datetime.datetime.strptime(expires, '%Y-%m-%d %H:%M:%S')
         if expires < datetime.datetime.utcnow():
-            log.info(f"Expired domain in database {domain} {expires}. Deleted")
-            with self.lock:
-                cursor.execute("delete from domains where domain=?", (domain,))
-                db.commit()
-                self.stats.delete += 1
+            self._expired(domain, expires, peek)
             return (None,None,None,None)
-        if isc != "LOCAL":
+        if isc != "LOCAL" and isc != "RDAP":
             isc = datetime.datetime.strptime(isc, '%Y-%m-%d %H:%M:%S')
         if you != "FIRST-CONTACT":
             you = datetime.datetime.strptime(you, '%Y-%m-%d %H:%M:%S')
-        else:
-            with self.lock:
-                cursor.execute("update domains set seen_by_you=? where domain =?", ((datetime.datetime.utcnow()+datetime.timedelta(hours=timezone_offset)).strftime("%Y-%m-%d %H:%M:%S"), domain))
-                db.commit()
+        elif not peek:
+            first_contact = (datetime.datetime.utcnow()+datetime.timedelta(hours=timezone_offset)).strftime("%Y-%m-%d %H:%M:%S")
+            self._write("touch", domain, (first_contact, domain), tuple(record[:3]) + (first_contact,))
         self.stats.hit += 1
         return (web,expires,isc,you)
 
-    def process_update_file(self, update_file):
+    def _decode_epoch_record(self, domain, record, peek=False):
+        #Schema version 2. Only the expiration has to be checked before building the datetimes.
+        web, expires, isc, you, flags = record
+        now = int(time.time())
+        if expires < now:
+            self._expired(domain, expires, peek)
+            return (None,None,None,None)
+        if flags & schema.ISC_LOCAL:
+            isc = "LOCAL"
+        elif flags & schema.ISC_RDAP:
+            isc = "RDAP"
+        else:
+            isc = schema.from_epoch(isc)
+        if flags & schema.FIRST_CONTACT:
+            you = "FIRST-CONTACT"
+            if not peek:
+                self._write("touch", domain, (now, domain), (web, expires, record[2], now, flags & ~schema.FIRST_CONTACT))
+        else:
+            you = schema.from_epoch(you)
+        self.stats.hit += 1
+        return (schema.from_epoch(web), schema.from_epoch(expires), isc, you)
+
+    def process_update_file(self, update_file, chunk_rows=20000, defer_indexes=False):
         """ Process csv in the format command, domain, web, expire, seen_by_isc """
         """ if command is + we add the record setting if it doesnt already exist"""
         """ if command is - we delete the record"""
+        """ The file is streamed and applied chunk_rows at a time with executemany. Each chunk is its own transaction."""
+        """ Set defer_indexes to drop the secondary indexes on domains during the load and rebuild them at the end."""
         if not pathlib.Path(update_file).exists():
             log.info(f"The specified update file {update_file} does not exists.")
             return 0
-        new_domains = open(update_file).readlines()
-        num_recs = len(new_domains)
-        db = sqlite3.connect(self.filename, timeout=15)
-        cursor = db.cursor()    
-        for pos,entry in enumerate(new_domains):
-            if pos % 50 == 0:
-                print("\r|{0:-<50}| {1:3.2f}%".format("X"*( 50 * pos//num_recs), 100*pos/num_recs),end="")
-            command, domain, web, expires = entry.strip().split(",")
-            domain = reduce_domain(domain)
-            web = datetime.datetime.strptime(web, '%Y-%m-%d %H:%M:%S')
-            expires = datetime.datetime.strptime(expires, '%Y-%m-%d %H:%M:%S')
-            if command == "+":
-                record = cursor.execute("select seen_by_web, expires, seen_by_isc, seen_by_you from domains where domain = ?" , (domain,) ).fetchone()
-                if not record:
-                    self.update_record(domain, web, expires,"LOCAL", "FIRST-CONTACT")
-                    log.debug(f"Record added to database for domain {domain}")
-                else:
-                    log.debug(f"Record already exists skipped {domain}")
-            elif command == "-":
-                self.delete_record(domain)
-                log.debug(f"Deleted record for {domain}")
-        db.commit()
+        self.flush()
+        self._drop_index(f"Applying update file {update_file}.")
+        file_size = pathlib.Path(update_file).stat().st_size or 1
+        start = time.perf_counter()
+        num_recs = inserted = deleted = bytes_read = 0
+        with self.connection() as db, open(update_file, "rb") as fh:
+            #The lock and the sqlite write lock are only held for one chunk at a time so lookups can write between chunks.
+            #A file that fails part way can be applied again. + only adds missing records and - only removes them.
+            indexes = []
+            try:
+                if defer_indexes:
+                    with self.lock:
+                        db.execute("BEGIN")
+                        indexes = db.execute("select name, sql from sqlite_master where type='index' and tbl_name='domains' and sql is not null").fetchall()
+                        for name,_ in indexes:
+                            db.execute(f"drop index {name}")
+                        db.commit()
+                while True:
+                    lines = list(itertools.islice(fh, chunk_rows))
+                    if not lines:
+                        break
+                    bytes_read += sum(map(len, lines))
+                    with self.lock:
+                        db.execute("BEGIN")
+                        #Consecutive rows with the same command are applied together so the order of + and - is preserved
+                        for command, rows in itertools.groupby(map(self._parse_update_line, lines), key=operator.itemgetter(0)):
+                            before = db.total_changes
+                            if command == "+":
+                                if self.bloom:
+                                    rows = list(rows)
+                                    self.bloom.update(row[1] for row in rows)
+                                db.executemany(self.write_sql["load"], (row[1:] for row in rows))
+                                inserted += db.total_changes - before
+                            elif command == "-":
+                                db.executemany("delete from domains where domain=?", (row[1:2] for row in rows))
+                                deleted += db.total_changes - before
+                        db.commit()
+                    num_recs += len(lines)
+                    print("\r|{0:-<50}| {1:3.2f}%".format("X"*( 50 * bytes_read//file_size), 100*bytes_read/file_size),end="")
+            finally:
+                #Put the indexes back and record the change even if the load stopped part way
+                with self.lock:
+                    if db.in_transaction:
+                        db.rollback()
+                    db.execute("BEGIN")
+                    for _,sql in indexes:
+                        db.execute(sql)
+                    self._touch_lastupdate(db)
+                    db.commit()
+        self.stats.insert += inserted
+        self.stats.delete += deleted
+        elapsed = max(time.perf_counter() - start, 0.000001)
         print("\r|XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX| 100.00% FINISHED")
+        print(f"Processed {num_recs} rows in {elapsed:.2f} seconds ({num_recs/elapsed:.0f} rows/sec). {inserted} added. {deleted} deleted.")
+        log.info(f"Update file {update_file} processed {num_recs} rows in {elapsed:.2f} seconds ({num_recs/elapsed:.0f} rows/sec). {inserted} added. {deleted} deleted.")
         return num_recs
 
-    def update_database(self, latest_version, update_url):
+    def _parse_update_line(self, entry):
+        entry = entry.decode().strip()
+        if not entry:
+            return (None,)
+        command, domain, web, expires = entry.split(",")
+        domain = public_suffix.reduce_domain(domain)
+        web = datetime.datetime.fromisoformat(web)
+        expires = datetime.datetime.fromisoformat(expires)
+        if self.schema >= 2:
+            return (command, domain, schema.to_epoch(web), schema.to_epoch(expires))
+        return (command, domain, web.strftime('%Y-%m-%d %H:%M:%S'), expires.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def download_updates(self, update_url, major, minors, max_downloads=4):
+        """Download the update files for minors of major version major at the same time. update_url may be an
+           http(s) or file:// URL or a local directory. A file that was already downloaded is not fetched again.
+           Returns a list of (minor, path) in order."""
+        if not urllib.parse.urlsplit(update_url).scheme:
+            update_url = pathlib.Path(update_url).resolve().as_uri()
+        folder = pathlib.Path().cwd() / "data" / f"{major}"
+        folder.mkdir(parents=True, exist_ok=True)
+        def fetch(minor):
+            dst_path = folder / f"{minor}.txt"
+            if not dst_path.exists():
+                #Downloads go to a .part file so an interrupted download is never mistaken for a complete one
+                part_path = folder / f"{minor}.txt.part"
+                urllib.request.urlretrieve(f"{update_url}/{major}/{minor}.txt", str(part_path))
+                os.replace(part_path, dst_path)
+                log.info(f"Downloaded update {major}.{minor}")
+            return minor, str(dst_path)
+        with concurrent.futures.ThreadPoolExecutor(max(1, min(max_downloads, len(minors)))) as pool:
+            return list(pool.map(fetch, minors))
+
+    def _open_shadow(self, shadow_file, major, minor):
+        #A shadow copy left by an interrupted update is resumed if it is between the live version and the target
+        if pathlib.Path(shadow_file).exists():
+            shadow = DomainStatsDatabase(shadow_file)
+            shadow_major, shadow_minor = schema.parse_version(shadow.version)
+            if shadow_major == major and shadow_minor >= minor:
+                log.info(f"Resuming the update in {shadow_file} from version {shadow.version}")
+                return shadow
+            shadow.close()
+            log.info(f"Discarding {shadow_file}. It is version {shadow.version}.")
+        for suffix in ("", "-wal", "-shm"):
+            pathlib.Path(f"{shadow_file}{suffix}").unlink(missing_ok=True)
+        #The backup API copies a consistent snapshot while the live database keeps serving
+        tmp_file = f"{shadow_file}.tmp"
+        pathlib.Path(tmp_file).unlink(missing_ok=True)
+        start = time.perf_counter()
+        with self.connection() as db:
+            copy = sqlite3.connect(tmp_file)
+            db.backup(copy)
+            copy.close()
+        os.replace(tmp_file, shadow_file)
+        log.info(f"Copied {self.filename} to {shadow_file} in {time.perf_counter() - start:.2f} seconds")
+        return DomainStatsDatabase(shadow_file)
+
+    def _swap_in(self, shadow):
+        #Carry the first contacts and lookups made while the update ran over to the copy, then copy it over the live
+        #database with the backup API. Readers see the old database or the new one and never a mix of the two.
+        self.flush()
+        start = time.perf_counter()
+        with shadow.connection() as copy, self.connection() as db, self.lock:
+            copy.execute("ATTACH DATABASE ? AS live", (self.filename,))
+            copy.execute("BEGIN")
+            for sql in schema.MERGE_SQL[self.schema]:
+                copy.execute(sql)
+            copy.commit()
+            copy.execute("DETACH DATABASE live")
+            copy.backup(db)
+            self.version, self.lastupdate = db.execute("select version,lastupdate from info").fetchone()
+        log.info(f"Swapped in the updated database in {time.perf_counter() - start:.2f} seconds")
+
+    def update_database(self, latest_version, update_url, defer_indexes=False, max_downloads=4):
+        """Bring the database up to latest_version. The update files are downloaded at the same time and applied to
+           a shadow copy of the database which then replaces the live one. Lookups are answered from the live
+           database throughout. If the update is interrupted the next one continues from the shadow copy."""
         new_records_count = 0
-        latest_major, latest_minor = map(int, str(latest_version).split("."))
-        current_major, current_minor = map(int, str(self.version).split("."))
+        latest_major, latest_minor = schema.parse_version(latest_version)
+        current_major, current_minor = schema.parse_version(self.version)
         log.info(f"Updating from {self.version} to {latest_version}")
         if latest_major > current_major:
             log.info("WARNING: Domain Stats database is a major revision behind. Database required rebuild.")
             raise Exception("WARNING: Domain Stats database is a major revision behind. Database required rebuild.")
         target_updates = range(current_minor+1, latest_minor+1 )
-        for update in target_updates:
-            version = f"{current_major}.{update}"
-            log.info(f"Now applying update {version}")
-            tgt_url = f"{update_url}/{current_major}/{update}.txt" 
-            dst_path = pathlib.Path().cwd() / "data" / f"{current_major}" / f"{update}.txt"
-            urllib.request.urlretrieve(tgt_url, str(dst_path))
-            new_records_count += self.process_update_file(str(dst_path))
-        self.version = latest_version
-        self.lastupdate = datetime.datetime.utcnow()
-        db = sqlite3.connect(self.filename, timeout=15)
-        cursor = db.cursor()
-        cursor.execute("update info set version=?, lastupdate=?",(self.version, self.lastupdate))
-        db.commit()
-        return latest_version, new_records_count
\ No newline at end of file
+        updates = self.download_updates(update_url, current_major, list(target_updates), max_downloads)
+        shadow_file = f"{self.filename}.update"
+        shadow = self._open_shadow(shadow_file, current_major, current_minor)
+        try:
+            _, shadow_minor = schema.parse_version(shadow.version)
+            #A real version column would store 1.10 as 1.1 and the next update would start again from 1.1
+            with shadow.connection() as db:
+                if not schema.info_is_text(db):
+                    db.execute("BEGIN")
+                    for sql in schema.INFO_TEXT_SQL:
+                        db.execute(sql)
+                    db.commit()
+            for update, update_file in updates:
+                if update <= shadow_minor:
+                    continue
+                version = f"{current_major}.{update}"
+                log.info(f"Now applying update {version}")
+                try:
+                    new_records_count += shadow.process_update_file(update_file, defer_indexes=defer_indexes)
+                except Exception:
+                    #Download it again next time in case the file is damaged
+                    pathlib.Path(update_file).unlink(missing_ok=True)
+                    raise
+                #Recorded after each file so an interrupted update resumes after the last one applied
+                with shadow.connection() as db:
+                    db.execute("update info set version=?, lastupdate=?",(version, datetime.datetime.utcnow()))
+                    db.commit()
+                shadow.version = version
+            self._swap_in(shadow)
+        finally:
+            shadow.close()
+        for suffix in ("", "-wal", "-shm"):
+            pathlib.Path(f"{shadow_file}{suffix}").unlink(missing_ok=True)
+        self._drop_index(f"The database was updated to {latest_version}.")
+        if self.bloom:
+            #Lookups query the database until the filter has the domains the update added
+            self.start_bloom_filter(*self.bloom_args)
+        return latest_version, new_records_count
@@ -0,0 +1,144 @@
+import array
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import time
+import logging
+import include.schema as schema
+
+log = logging.getLogger("domain_stats")
+
+#A compiled, read only copy of the domains table that is memory mapped by every server process.
+#  header:  magic, format version, reserved, entry count, database version text, database lastupdate, time.time() it was compiled
+#  hashes:  entry count little endian uint64 domain hashes in ascending order
+#  records: entry count (seen_by_web, expires, seen_by_isc, seen_by_you) int64 seconds since the epoch in the same order
+#seen_by_isc is UNSET for LOCAL and seen_by_you is UNSET for FIRST-CONTACT.
+#Only the 64 bit hash of a domain is stored. With n domains a domain that is not in the index matches one with
+#probability n/2**64 which is about 1 in 3 trillion for the 6 million established domains.
+MAGIC = b"DSINDEX\x00"
+#Version 1 kept the database version as a double which can't tell 1.1 from 1.10
+VERSION = 2
+HEADER = struct.Struct("<8sHHQ16s32sd")
+RECORD = struct.Struct("<qqqq")
+UNSET = 0
+
+
+class DomainIndexError(Exception):
+    pass
+
+
+def domain_hash(domain):
+    #hash() is randomized per process. The index is shared by processes so it needs a stable hash.
+    return int.from_bytes(hashlib.blake2b(domain.encode(), digest_size=8).digest(), "little")
+
+def _text_entry(domain, web, expires, isc, you):
+    #Schema version 1
+    isc = UNSET if isc == "LOCAL" else schema.text_to_epoch(isc)
+    you = UNSET if you == "FIRST-CONTACT" else schema.text_to_epoch(you)
+    return (domain_hash(domain), schema.text_to_epoch(web), schema.text_to_epoch(expires), isc, you)
+
+def _epoch_entry(domain, web, expires, isc, you, flags):
+    if flags & schema.ISC_RDAP:
+        raise ValueError("RDAP records are not indexed")
+    isc = UNSET if flags & schema.ISC_LOCAL else isc
+    you = UNSET if flags & schema.FIRST_CONTACT else you
+    return (domain_hash(domain), web, expires, isc, you)
+
+def write(db, filename, version, lastupdate, schema_version=1):
+    """Write every row of the domains table on sqlite connection db to filename. version and lastupdate come from
+       the info table and are checked when the index is opened. The file is replaced atomically. Returns the
+       number of domains in the index."""
+    entries = []
+    skipped = 0
+    make_entry = _epoch_entry if schema_version >= 2 else _text_entry
+    cursor = db.execute(f"select domain, {schema.COLUMNS[schema_version]} from domains")
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        for row in rows:
+            try:
+                entries.append(make_entry(*row))
+            except ValueError:
+                #Anything the index can't represent (RDAP as seen_by_isc) is left to sqlite
+                skipped += 1
+    entries.sort()
+    #Two domains with the same hash can't be told apart. Leave both of them to sqlite.
+    duplicates = {entries[pos][0] for pos in range(1, len(entries)) if entries[pos][0] == entries[pos-1][0]}
+    if duplicates:
+        entries = [entry for entry in entries if entry[0] not in duplicates]
+    tmp = f"{filename}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, VERSION, 0, len(entries), str(version).encode()[:16], str(lastupdate).encode()[:32], time.time()))
+        hashes = array.array("Q", (entry[0] for entry in entries))
+        if sys.byteorder == "big":
+            hashes.byteswap()
+        fh.write(hashes.tobytes())
+        for entry in entries:
+            fh.write(RECORD.pack(*entry[1:]))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, filename)
+    log.info(f"Compiled {len(entries)} domains to {filename}. {skipped + len(duplicates)} were left to the database.")
+    return len(entries)
+
+
+class DomainIndex(object):
+    """Lookups in a compiled index. The file is memory mapped read only so the pages are shared by every
+       process that opens it and only the pages a binary search touches are read from disk."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            if size < HEADER.size:
+                raise DomainIndexError(f"{filename} is not a domain index")
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.count, self.version, lastupdate, self.compiled = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise DomainIndexError(f"{filename} is not a domain index")
+        if version != VERSION:
+            self.close()
+            raise DomainIndexError(f"{filename} is index version {version}. Version {VERSION} is supported. Recompile it with database_admin --compile.")
+        self.version = self.version.rstrip(b"\x00").decode()
+        self.lastupdate = lastupdate.rstrip(b"\x00").decode()
+        self.records_offset = HEADER.size + self.count * 8
+        if size < self.records_offset + self.count * RECORD.size:
+            self.close()
+            raise DomainIndexError(f"{filename} is truncated")
+        #bisect searches the uint64 array in place without copying it out of the map. cast() uses the native byte order.
+        if sys.byteorder == "big":
+            self.close()
+            raise DomainIndexError("Domain indexes are little endian")
+        self.view = memoryview(self.map)
+        self.hashes = self.view[HEADER.size:self.records_offset].cast("Q")
+
+    def matches(self, version, lastupdate):
+        """True if the index was compiled from a database with this version and lastupdate"""
+        return schema.parse_version(version) == schema.parse_version(self.version) and str(lastupdate)[:32] == self.lastupdate
+
+    def get(self, domain):
+        """Returns the (seen_by_web, expires, seen_by_isc, seen_by_you) seconds for domain or None if it isn't in the index"""
+        hashed = domain_hash(domain)
+        pos = bisect.bisect_left(self.hashes, hashed)
+        if pos == self.count or self.hashes[pos] != hashed:
+            return None
+        return RECORD.unpack_from(self.map, self.records_offset + pos * RECORD.size)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return f"DomainIndex({self.filename}, domains={self.count}, version={self.version}, lastupdate={self.lastupdate})"
+
+    def close(self):
+        #The views have to be released before the map can be closed
+        for view in ("hashes", "view"):
+            if getattr(self, view, None) is not None:
+                getattr(self, view).release()
+                setattr(self, view, None)
+        self.map.close()
@@ -1,47 +1,142 @@
 import collections
 import datetime
+import heapq
+import time
 import resource
 import sys
-import pickle
 import threading
 import logging 
+import include.cache_snapshot as cache_snapshot
+import include.cache_policy as cache_policy
 
 log = logging.getLogger("domain_stats")
 
+#Entries with an expiration are kept in buckets of this many seconds. A bucket is dropped once all of it has expired.
+EXPIRY_BUCKET = 60
+#Bytes an entry uses besides its key and data: the CacheEntry and its share of the dict it is in. An entry with an
+#expiration also has its int and a slot in a bucket.  Measured with tracemalloc on CPython 3.11.
+ENTRY_BYTES = 152
+EXPIRY_BYTES = 40
+
 class cache_stats:
-    def __init__(self,hit=0, miss=0, expire=0):
+    def __init__(self,hit=0, miss=0, expire=0, evict=0):
         self.hit = hit
         self.miss = miss
         self.expire = expire
+        self.evict = evict
 
     def __repr__(self):
-        return f"cache_stats(hit={self.hit}, miss={self.miss}, expire={self.expire})"
+        return f"cache_stats(hit={self.hit}, miss={self.miss}, expire={self.expire}, evict={self.evict})"
 
     def reset(self):
-        self.hit = self.miss = self.expire = 0
+        self.hit = self.miss = self.expire = self.evict = 0
+
+
+class CacheEntry(object):
+    """expires is an int time.monotonic() second or a negative hours_to_live. Slots make it 56 bytes where a list is 88."""
+    __slots__ = ("expires", "read_count", "data")
 
+    def __init__(self, expires, read_count, data):
+        self.expires = expires
+        self.read_count = read_count
+        self.data = data
 
-class ExpiringCache(collections.OrderedDict, collections.Counter):
+
+class ExpiringCache(object):
     """This is a Least Recently Used Expiring Cache. Reading or setting a record makes it the most recently used.
        When an item is added such that the maxsize is exceeded the least recently used entry is dropped.
        Additionally entries will be marked with an expiration date.  If the expiration is exceeded None is retreieved
-       and the entry is deleted when you query a value in the dictionary.""" 
+       and the entry is deleted when you query a value in the dictionary.
+       Entries are CacheEntry objects.  Entries that can page out live in an OrderedDict in LRU order and permanent (-2)
+       entries live in their own dict so a hit, an insert and an eviction are all O(1).  The keys of entries with an
+       expiration are also kept in buckets on a heap so expired entries are dropped before a live entry is evicted.
+       The cache holds at most maxsize entries and, if max_bytes is set, at most max_bytes of memory.
+       policy picks which live entry is evicted.  "lru" is the default and "tinylfu" keeps frequently requested
+       entries when a burst of one off keys is added.  See cache_policy.py."""
 
-    def __init__(self, maxsize = 65535, default_hours_to_live=720, *args, **kwargs):
+    def __init__(self, maxsize = 65535, default_hours_to_live=720, policy="lru", max_bytes=0, *args, **kwargs):
         self.maxsize = maxsize
+        #0 is no limit
+        self.max_bytes = max_bytes
+        self.bytes = 0
         #Set to -1 for no expirations and it behaves like a regular LRU cache 
         self.hours_to_live = default_hours_to_live
         self.stats = cache_stats()
         self.update_lock = threading.Lock()
-        super().__init__()
+        self._lru = collections.OrderedDict()
+        self._pinned = {}
+        #A heap of bucket numbers and the keys in each bucket
+        self._expiry = []
+        self._buckets = {}
+        self._bucketed = 0
+        self.policy = cache_policy.create(policy, self._lru, maxsize)
+        #Set by refresh_ahead()
+        self.refresh_seconds = 0
+        self.on_refresh = None
+
+    def __len__(self):
+        return len(self._lru) + len(self._pinned)
 
-    def __contains__(self,*args,**kwargs):
+    def refresh_ahead(self, minutes, on_refresh):
+        """Call on_refresh(key) when a hit finds the entry expires within minutes. The hit still returns the cached data.
+           on_refresh is called while the cache is locked so it must only queue the key."""
+        self.refresh_seconds = minutes * 60
+        self.on_refresh = on_refresh
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
         log.info("Warning: __contains__ called with 'in' keyword.  This will likely skew your cache.stats.miss accuracy.  Instead just get() check for none being returned.")
-        return super().__contains__(*args,**kwargs)
+        return key in self._lru or key in self._pinned
+
+    def __delitem__(self, key):
+        with self.update_lock:
+            if self._pop_entry(key) is None:
+                raise KeyError(key)
+
+    def keys(self):
+        with self.update_lock:
+            return list(self._lru) + list(self._pinned)
+
+    def items(self):
+        """(key, (expires, read_count, data)) for every entry. expires is a utc datetime or a negative hours_to_live"""
+        with self.update_lock:
+            entries = list(self._lru.items()) + list(self._pinned.items())
+        now, utcnow = time.monotonic(), datetime.datetime.utcnow()
+        return [(key, (self._to_datetime(entry.expires, now, utcnow), entry.read_count, entry.data)) for key, entry in entries]
+
+    def clear(self):
+        with self.update_lock:
+            self._lru.clear()
+            self._pinned.clear()
+            self._expiry.clear()
+            self._buckets.clear()
+            self._bucketed = 0
+            self.bytes = 0
+            self.policy.clear()
+
+    @staticmethod
+    def _to_datetime(expires, now, utcnow):
+        if expires < 0:
+            return expires
+        return utcnow + datetime.timedelta(seconds=expires - now)
+
+    def _entry_bytes(self, key, entry):
+        size = ENTRY_BYTES + sys.getsizeof(key) + sys.getsizeof(entry.data)
+        if entry.expires >= 0:
+            return size + EXPIRY_BYTES + self.policy.entry_bytes
+        if entry.expires == -1:
+            return size + self.policy.entry_bytes
+        return size
+
+    def cache_bytes(self):
+        """Memory used by the cache: every entry, key and value and the hash tables holding them"""
+        return self.bytes
 
     def cache_info(self):
         """JSON transmitable Report cache performance statistics"""
-        rpt =  f"""{self.stats}, ('Max Size': {self.maxsize}, 'Current size': {len(self)}, 'Cache Bytes':{sys.getsizeof(self)}, 'Application Kilobytes':{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})"""
+        rpt =  f"""{self.stats}, ('Max Size': {self.maxsize}, 'Current size': {len(self)}, 'Cache Bytes':{self.cache_bytes()}, 'Max Bytes':{self.max_bytes}, 'Application Kilobytes':{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})"""
         return rpt
 
     def cache_report(self):
@@ -55,17 +150,60 @@ class ExpiringCache(collections.OrderedDict, collections.Counter):
 
     def cache_dump(self, fname):
         log.debug(f"Dumping cache to file {fname}")
-        with open(fname,"wb") as fhandle:
-            pickle.dump(list(self.items()), fhandle, protocol=pickle.HIGHEST_PROTOCOL)
+        return cache_snapshot.write(fname, self.snapshot_entries())
 
-    def cache_load(self, fname):
+    def cache_load(self, fname, background=False):
+        """Replace the contents of the cache with a snapshot written by cache_dump.
+           With background the snapshot is loaded on a thread that is returned and the cache can be used meanwhile."""
         log.debug(f"Loading cache from file {fname}")
         self.clear()
-        with open(fname, "rb") as fhandle:
-            other = pickle.load(fhandle)
-            for key,val in other:
-                with self.update_lock:
-                    super().__setitem__(key, val)
+        if background:
+            return cache_snapshot.load_in_background(self, fname)
+        return cache_snapshot.load(self, fname)
+
+    def snapshot_entries(self):
+        """(key, expires, read_count, data) in LRU order. expires is a time.time() second or a negative hours_to_live"""
+        with self.update_lock:
+            entries = list(self._pinned.items()) + list(self._lru.items())
+        offset = time.time() - time.monotonic()
+        return [(key, entry.expires if entry.expires < 0 else entry.expires + offset, entry.read_count, entry.data) for key, entry in entries]
+
+    def load_entries(self, entries):
+        """Insert entries in the snapshot_entries() format. Keys already in the cache are newer and are kept."""
+        now = time.monotonic()
+        offset = now - time.time()
+        lru, pinned, record_insert, add_expiry = self._lru, self._pinned, self.policy.record_insert, self._add_expiry
+        entry_bytes = self._entry_bytes
+        with self.update_lock:
+            #_insert() inlined. This runs for every entry when a multi-million entry cache is restored.
+            for key, expires, read_count, data in entries:
+                if key in lru or key in pinned:
+                    continue
+                if expires >= 0:
+                    expires = int(expires + offset)
+                    if expires <= now:
+                        continue
+                    add_expiry(expires, key)
+                entry = CacheEntry(int(expires), read_count, data)
+                self.bytes += entry_bytes(key, entry)
+                if expires == -2:
+                    pinned[key] = entry
+                    continue
+                lru[key] = entry
+                record_insert(key)
+            self._enforce_size(now)
+
+    def load_items(self, other):
+        """Insert (key, (expires, read_count, data)) entries in the format returned by items()"""
+        now, utcnow = time.monotonic(), datetime.datetime.utcnow()
+        with self.update_lock:
+            for key,(expires, read_count, data) in other:
+                if isinstance(expires, datetime.datetime):
+                    expires = now + (expires - utcnow).total_seconds()
+                    if expires <= now:
+                        continue
+                self._insert(key, CacheEntry(int(expires), read_count, data))
+            self._enforce_size(now)
 
     def get(self,key,default_value=None):
         retval = self[key]
@@ -73,39 +211,106 @@ class ExpiringCache(collections.OrderedDict, collections.Counter):
             return default_value
         return retval
 
-
     def __getitem__(self, key):
-        if key in self:
-            expiration, read_count, data = super().__getitem__(key)
-            del self[key]
-            #If it set to never expire or it is not expired then update the hit count and recreate the record.
-            if (type(expiration)==int and expiration<0) or (type(expiration)==datetime.datetime and (expiration > datetime.datetime.utcnow())):
+        with self.update_lock:
+            entry = self._lru.get(key)
+            pinned = entry is None
+            if pinned:
+                entry = self._pinned.get(key)
+                if entry is None:
+                    self.stats.miss += 1
+                    self.policy.record_miss(key)
+                    return None
+            expiration = entry.expires
+            now = time.monotonic()
+            #If it set to never expire or it is not expired then update the hit count and make it most recently used.
+            if expiration < 0 or expiration > now:
                 self.stats.hit += 1
-                with self.update_lock:
-                    super().__setitem__(key, (expiration, read_count+1, data))
-                return data
-            else:
-                self.stats.expire += 1
-        else:
-            self.stats.miss += 1
+                entry.read_count += 1
+                if not pinned:
+                    self.policy.record_hit(key)
+                if expiration >= 0 and expiration - now < self.refresh_seconds:
+                    self.on_refresh(key)
+                return entry.data
+            self.stats.expire += 1
+            self._drop(key)
+            self.policy.record_remove(key)
+            self.policy.record_miss(key)
         return None
 
+    def _pop_entry(self, key):
+        entry = self._lru.pop(key, None)
+        if entry is not None:
+            self.policy.record_remove(key)
+        else:
+            entry = self._pinned.pop(key, None)
+            if entry is None:
+                return None
+        self.bytes -= self._entry_bytes(key, entry)
+        return entry
+
+    def _drop(self, key):
+        #Deletes an entry that can page out. The caller tells the policy if it needs to know.
+        self.bytes -= self._entry_bytes(key, self._lru.pop(key))
+
+    def _insert(self, key, entry):
+        self.bytes += self._entry_bytes(key, entry)
+        if entry.expires == -2:
+            self._pinned[key] = entry
+            return
+        self._lru[key] = entry
+        self.policy.record_insert(key)
+        if entry.expires >= 0:
+            self._add_expiry(entry.expires, key)
+            #Overwritten keys are left behind in their old bucket. Rebuild the buckets once they are half of the keys.
+            if self._bucketed > 2 * len(self._lru) + 1024:
+                self._expiry.clear()
+                self._buckets.clear()
+                self._bucketed = 0
+                for k, e in self._lru.items():
+                    if e.expires >= 0:
+                        self._add_expiry(e.expires, k)
+
+    def _add_expiry(self, expires, key):
+        bucket = expires // EXPIRY_BUCKET
+        keys = self._buckets.get(bucket)
+        if keys is None:
+            keys = self._buckets[bucket] = []
+            heapq.heappush(self._expiry, bucket)
+        keys.append(key)
+        self._bucketed += 1
+
+    def _purge_expired(self, now):
+        #Only whole buckets are dropped so an entry may outlive its expiration here by EXPIRY_BUCKET seconds.
+        #Lookups still treat it as expired.
+        while self._expiry and (self._expiry[0] + 1) * EXPIRY_BUCKET <= now:
+            keys = self._buckets.pop(heapq.heappop(self._expiry))
+            self._bucketed -= len(keys)
+            for key in keys:
+                entry = self._lru.get(key)
+                if entry is not None and 0 <= entry.expires <= now:
+                    self._drop(key)
+                    self.policy.record_remove(key)
+
+    def _over_size(self):
+        return len(self) > self.maxsize or (self.max_bytes and self.bytes > self.max_bytes)
+
+    def _enforce_size(self, now):
+        if not self._over_size():
+            return
+        self._purge_expired(now)
+        while self._over_size():
+            key = self.policy.victim() if self._lru else None
+            if key is None:
+                print("Unable to delete any keys but the maximum size is exceeded.  Ignoring Maxsize.")
+                break
+            self._drop(key)
+            self.stats.evict += 1
+
     def enforce_size(self):
-        """Delete items from front of dict (First in) unless it has an expiration of -2 until the length is < self.maxsize"""
-        entries = iter(self.keys())
+        """Delete expired items then items from front of dict (First in) unless it has an expiration of -2 until the length is < self.maxsize"""
         with self.update_lock:
-            while len(self) > self.maxsize:
-                try:
-                    tgt_key= next(entries)
-                except StopIteration:
-                    print("Unable to delete any keys but the maximum size is exceeded.  Ignoring Maxsize.")
-                    break
-                else:
-                    expires,_,_ = super().get(tgt_key)
-                    if expires != -2:
-                        del self[tgt_key]
-                        entries = iter(self.keys())
-
+            self._enforce_size(time.monotonic())
 
     def set(self, key, value, update_expiration=True, reset_read_count=False, hours_to_live=None):
         """If update_expiration is True then the expiration date is updated on overwrites to existing keys"""
@@ -114,45 +319,111 @@ class ExpiringCache(collections.OrderedDict, collections.Counter):
         """Setting hours_to_live to -1 and they won't expire but can page out if least recently used."""
         """Set to -2 and they do not expire and the LRU can not remove them. Permanent entries in the cache (use with caution)"""
         """Set to 0 and the record is treated as already expired. nothing is added to the cache"""
-        log.debug(f"cache set called {key} {value} {hours_to_live}")
         if hours_to_live == None:
             hours_to_live = self.hours_to_live
         if hours_to_live == 0:
-            log.debug(f"hours to live set to zero.  Not caching. {key} {value}")
+            log.debug("hours to live set to zero.  Not caching. %s", key)
             return
+        now = time.monotonic()
         if hours_to_live < 0:
-            expires = hours_to_live
+            expires = int(hours_to_live)
         else:
-            expires = datetime.datetime.utcnow() + datetime.timedelta(hours=hours_to_live)
+            expires = int(now + hours_to_live * 3600)
         read_count = 0
-        if key in self:
-            with self.update_lock:
-                current_expires,current_read_count,value = super().__getitem__(key)
-                del self[key]
-            if not update_expiration and (current_expires < datetime.datetime.utcnow()):
-                expires = current_expires
-            if not reset_read_count:
-                read_count = current_read_count
         with self.update_lock:
-            super().__setitem__( key, (expires, read_count, value))
-        self.enforce_size()
+            current = self._pop_entry(key)
+            if current:
+                if not update_expiration and (current.expires < 0 or current.expires > now):
+                    expires = current.expires
+                if not reset_read_count:
+                    read_count = current.read_count
+            self._insert(key, CacheEntry(expires, read_count, value))
+            self._enforce_size(now)
 
     def __setitem__(self, key, value):
-        if self.hours_to_live == 0:
-            return
-        if self.hours_to_live < 0:
-            expires = self.hours_to_live
-        else:
-            expires = datetime.datetime.utcnow() + datetime.timedelta(hours=self.hours_to_live)
-        read_count = 0
-        if key in self:
-            current_expires,read_count,value = super().__getitem__(key)
-            del self[key]
-            if current_expires < datetime.datetime.utcnow():
-                expires = current_expires
-        with self.update_lock:
-            super().__setitem__( key, (expires, read_count, value))
-        self.enforce_size()
+        self.set(key, value)
+
+
+class ShardedExpiringCache(ExpiringCache):
+    """An ExpiringCache split into shards by the hash of the key. Each shard is an ExpiringCache with its own lock
+       so request threads working on different keys do not wait on each other.  LRU order and maxsize are kept per shard.
+       stats is the sum of the per shard stats, which are only updated while holding that shard's lock."""
+
+    def __init__(self, maxsize = 65535, default_hours_to_live=720, shards=8, policy="lru", max_bytes=0, *args, **kwargs):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hours_to_live = default_hours_to_live
+        self.shards = [ExpiringCache(-(-maxsize // shards), default_hours_to_live, policy, -(-max_bytes // shards)) for _ in range(shards)]
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    @property
+    def stats(self):
+        total = cache_stats()
+        for shard in self.shards:
+            total.hit += shard.stats.hit
+            total.miss += shard.stats.miss
+            total.expire += shard.stats.expire
+            total.evict += shard.stats.evict
+        return total
+
+    def __len__(self):
+        return sum(map(len, self.shards))
+
+    def refresh_ahead(self, minutes, on_refresh):
+        for shard in self.shards:
+            shard.refresh_ahead(minutes, on_refresh)
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def keys(self):
+        return [key for shard in self.shards for key in shard.keys()]
+
+    def items(self):
+        return [item for shard in self.shards for item in shard.items()]
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    @property
+    def bytes(self):
+        return sum(shard.bytes for shard in self.shards)
+
+    def cache_bytes(self):
+        return sum(shard.cache_bytes() for shard in self.shards)
+
+    def load_items(self, other):
+        for shard, items in zip(self.shards, self._partition(other)):
+            shard.load_items(items)
+
+    def snapshot_entries(self):
+        return [entry for shard in self.shards for entry in shard.snapshot_entries()]
+
+    def load_entries(self, entries):
+        for shard, shard_entries in zip(self.shards, self._partition(entries)):
+            shard.load_entries(shard_entries)
+
+    def _partition(self, entries):
+        partitions = [[] for _ in self.shards]
+        for entry in entries:
+            partitions[hash(entry[0]) % len(self.shards)].append(entry)
+        return partitions
+
+    def enforce_size(self):
+        for shard in self.shards:
+            shard.enforce_size()
+
+    def set(self, key, value, update_expiration=True, reset_read_count=False, hours_to_live=None):
+        self._shard(key).set(key, value, update_expiration, reset_read_count, hours_to_live)
 
 
 def expiring_cache(maxsize=65535, cacheable = lambda _:True, hours_to_live=720):
@@ -0,0 +1,55 @@
+import threading
+import time
+import logging
+
+log = logging.getLogger("domain_stats")
+
+
+class ExpirySweeper(object):
+    """A background thread that deletes domains whose registration has expired.
+       Every interval_minutes it deletes batch_rows expired rows per transaction, pausing pause_ms between
+       transactions so request threads waiting to write never wait long. After a sweep it returns up to
+       vacuum_pages free pages to the file system and lets sqlite refresh its query planner statistics."""
+
+    def __init__(self, database, interval_minutes=60, batch_rows=500, pause_ms=100, vacuum_pages=1000):
+        self.database = database
+        self.interval = interval_minutes * 60
+        self.batch_rows = batch_rows
+        self.pause = pause_ms / 1000
+        self.vacuum_pages = vacuum_pages
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="expiry-sweeper", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            #Building the index on an existing database can take a while so it is done here rather than at startup
+            self.database.create_expires_index()
+        except Exception as e:
+            log.error(f"Unable to create the expires index. The sweeper is stopped. {str(e)}")
+            return
+        while not self.stopping.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                log.error(f"Expired domain sweep failed. {str(e)}")
+            self.stopping.wait(self.interval)
+
+    def sweep(self):
+        start = time.perf_counter()
+        deleted = 0
+        while not self.stopping.is_set():
+            rows = self.database.sweep_expired(self.batch_rows)
+            deleted += rows
+            if rows < self.batch_rows:
+                break
+            self.stopping.wait(self.pause)
+        if deleted:
+            self.database.maintain(self.vacuum_pages)
+        log.info(f"Swept {deleted} expired domains from the database in {time.perf_counter() - start:.2f} seconds")
+        return deleted
+
+    def close(self):
+        """Stop after the current transaction"""
+        self.stopping.set()
+        self.thread.join()
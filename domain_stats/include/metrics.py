@@ -0,0 +1,59 @@
+import bisect
+import contextlib
+import threading
+
+#Upper bounds in seconds of the latency histogram buckets. A memory cache hit is microseconds and an RDAP lookup is seconds.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#How a request was resolved
+TIERS = ("cache", "sqlite", "rdap", "isc", "error")
+
+
+class RequestMetrics(object):
+    """Request latency histograms per resolution tier and the number of requests in flight.
+       prometheus() renders them and any other samples in the Prometheus text exposition format."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        #tier -> [per bucket counts with a final +Inf bucket, sum of seconds, count]
+        self.latency = {tier: [[0] * (len(buckets) + 1), 0.0, 0] for tier in TIERS}
+        self.requests_in_flight = 0
+
+    def observe(self, tier, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.latency[tier]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def in_flight(self):
+        with self.lock:
+            self.requests_in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.requests_in_flight -= 1
+
+    def prometheus(self, samples=()):
+        """samples is a list of (name, type, help, value) for gauges and counters kept elsewhere"""
+        lines = ["# HELP domain_stats_request_seconds Time to answer a domain lookup by how it was resolved",
+                 "# TYPE domain_stats_request_seconds histogram"]
+        with self.lock:
+            latency = {tier: (list(counts), total, count) for tier, (counts, total, count) in self.latency.items()}
+            samples = [("domain_stats_requests_in_flight", "gauge", "Requests being processed", self.requests_in_flight)] + list(samples)
+        for tier, (counts, total, count) in latency.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append(f'domain_stats_request_seconds_bucket{{tier="{tier}",le="{bound}"}} {cumulative}')
+            lines.append(f'domain_stats_request_seconds_sum{{tier="{tier}"}} {total}')
+            lines.append(f'domain_stats_request_seconds_count{{tier="{tier}"}} {count}')
+        for name, kind, description, value in samples:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
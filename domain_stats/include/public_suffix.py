@@ -0,0 +1,142 @@
+import functools
+import pathlib
+import logging
+import requests
+
+log = logging.getLogger("domain_stats")
+
+PUBLIC_SUFFIX_URL = "https://publicsuffix.org/list/public_suffix_list.dat"
+
+#Marks a trie node that is the end of a rule
+_END = None
+
+
+def legacy_reduce_domain(domain_in):
+    #The original approximation of a registered domain. Used when there is no public suffix list.
+    parts =  domain_in.strip().split(".")
+    if len(parts)> 2:
+        if parts[-1] not in ['com','org','net','gov','edu']:
+            if parts[-2] in ['co', 'com','ne','net','or','org','go','gov','ed','edu','ac','ad','gr','lg','mus','gouv']:
+                domain = ".".join(parts[-3:])
+            else:
+                domain = ".".join(parts[-2:])
+        else:
+            domain = ".".join(parts[-2:])
+    else:
+        domain = ".".join(parts)
+    return domain.lower()
+
+
+class PublicSuffixList(object):
+    """Reduces host names to the registered domain (the public suffix plus one label) using the Public Suffix List.
+       The rules are compiled into a trie of dicts keyed by label from the right so a lookup is one dict probe per label.
+       Results are memoized in an LRU of memo_size host names.  Only the ICANN section of the list is used unless
+       include_private is set because private suffixes (github.io...) have no registration record of their own.
+       Without a list file the legacy reduce_domain rules are used."""
+
+    def __init__(self, filename=None, memo_size=65536, include_private=False):
+        self.filename = filename
+        self.trie = None
+        if filename and pathlib.Path(filename).exists():
+            with open(filename, encoding="utf-8") as fh:
+                self.trie = self.compile(fh, include_private)
+        elif filename:
+            log.info(f"Public suffix list {filename} not found. Using the legacy domain rules.")
+        self.reduce_domain = functools.lru_cache(maxsize=memo_size)(self._reduce if self.trie else legacy_reduce_domain)
+
+    @staticmethod
+    def compile(lines, include_private=False):
+        trie = {}
+        rules = 0
+        for line in lines:
+            rule = line.strip()
+            if rule.startswith("// ===BEGIN PRIVATE DOMAINS===") and not include_private:
+                break
+            if not rule or rule.startswith("//"):
+                continue
+            rule = rule.split()[0].lower()
+            forms = {rule}
+            try:
+                forms.add(rule.encode("idna").decode())
+            except UnicodeError:
+                pass
+            for form in forms:
+                exception = form.startswith("!")
+                labels = form.lstrip("!").split(".")
+                node = trie
+                for label in reversed(labels[1:] if exception else labels):
+                    node = node.setdefault(label, {})
+                if exception:
+                    node["!" + labels[0]] = True
+                else:
+                    node[_END] = True
+            rules += 1
+        log.info(f"Compiled {rules} public suffix rules")
+        return trie
+
+    def suffix_labels(self, labels):
+        """Number of labels at the end of labels that are the public suffix"""
+        node = self.trie
+        #An unlisted TLD is a public suffix (the implicit "*" rule)
+        suffix = 1
+        for depth in range(1, len(labels) + 1):
+            label = labels[-depth]
+            if "!" + label in node:
+                return depth - 1
+            child = node.get(label)
+            if child is None:
+                child = node.get("*")
+                if child is None:
+                    break
+            if _END in child:
+                suffix = depth
+            node = child
+        return suffix
+
+    def _reduce(self, domain_in):
+        domain = domain_in.strip().lower().rstrip(".")
+        labels = domain.split(".")
+        keep = self.suffix_labels(labels) + 1
+        if len(labels) <= keep:
+            return domain
+        return ".".join(labels[-keep:])
+
+    def reduce_domains(self, domains):
+        """Reduce a list of host names. Repeated names are reduced once."""
+        reduce = self.reduce_domain
+        return [reduce(domain) for domain in domains]
+
+    def cache_info(self):
+        return self.reduce_domain.cache_info()
+
+
+_default = None
+
+def load(filename=None, memo_size=65536, include_private=False):
+    """Set the list used by the module level reduce_domain() and reduce_domains()"""
+    global _default
+    _default = PublicSuffixList(filename, memo_size, include_private)
+    return _default
+
+def default():
+    if not _default:
+        load("public_suffix_list.dat")
+    return _default
+
+def reduce_domain(domain):
+    return default().reduce_domain(domain)
+
+def reduce_domains(domains):
+    return default().reduce_domains(domains)
+
+def download(filename, url=PUBLIC_SUFFIX_URL):
+    """Download the current public suffix list to filename. Returns the number of rules it contains."""
+    resp = requests.get(url, timeout=30)
+    resp.raise_for_status()
+    rules = [line for line in resp.text.splitlines() if line.strip() and not line.startswith("//")]
+    if "com" not in rules:
+        raise ValueError(f"{url} did not return a public suffix list")
+    tmp = pathlib.Path(str(filename) + ".tmp")
+    tmp.write_text(resp.text, encoding="utf-8")
+    tmp.replace(filename)
+    return len(rules)
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+import logging
+import requests
+
+log = logging.getLogger("domain_stats")
+
+IANA_URL = "https://data.iana.org/rdap/dns.json"
+
+
+class BootstrapError(Exception):
+    pass
+
+
+def parse(text):
+    """{tld: RDAP base URL} from the text of an IANA RDAP bootstrap file (RFC 9224)"""
+    try:
+        services = json.loads(text)["services"]
+        registries = {}
+        for tlds, urls in ((service[0], service[1]) for service in services):
+            #Prefer https when a registry lists more than one URL
+            urls = sorted(urls, key=lambda url: not url.lower().startswith("https://"))
+            if urls:
+                for tld in tlds:
+                    registries[tld.lower()] = urls[0].rstrip("/")
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+        raise BootstrapError(f"Not an RDAP bootstrap file. {str(e)}")
+    if not registries:
+        raise BootstrapError("The RDAP bootstrap file lists no registries")
+    return registries
+
+
+class RdapBootstrap(object):
+    """Finds the RDAP server of the registry for a domain's TLD using a local copy of the IANA bootstrap file.
+       The copy is downloaded from url on a background thread when it is missing or older than refresh_hours.
+       Lookups keep using the copy already loaded while it downloads and base_url() is None until there is one."""
+
+    def __init__(self, filename, url=IANA_URL, refresh_hours=24, timeout=10):
+        self.filename = filename
+        self.url = url
+        self.refresh_seconds = refresh_hours * 3600
+        self.timeout = timeout
+        self.registries = {}
+        self.next_check = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        if os.path.exists(filename):
+            try:
+                self.load()
+            except (OSError, BootstrapError) as e:
+                log.info(f"Unable to load RDAP bootstrap file {filename}. {str(e)}")
+
+    def load(self):
+        with open(self.filename) as fh:
+            self.registries = parse(fh.read())
+        log.info(f"Loaded RDAP servers for {len(self.registries)} TLDs from {self.filename}")
+
+    def download(self):
+        resp = requests.get(self.url, timeout=self.timeout)
+        resp.raise_for_status()
+        #Parsed before it replaces the local copy so a bad download never replaces a good file
+        registries = parse(resp.text)
+        tmp = f"{self.filename}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fh:
+            fh.write(resp.text)
+        os.replace(tmp, self.filename)
+        self.registries = registries
+        log.info(f"Downloaded RDAP servers for {len(registries)} TLDs from {self.url}")
+
+    def check(self):
+        """Start a download if the local copy is missing or older than refresh_hours. Returns immediately."""
+        now = time.time()
+        if now < self.next_check:
+            return
+        if os.getpid() != self.pid:
+            #A download running in the parent is not running in this forked process
+            self.lock = threading.Lock()
+            self.refreshing = False
+            self.pid = os.getpid()
+        with self.lock:
+            if self.refreshing or now < self.next_check:
+                return
+            try:
+                age = now - os.path.getmtime(self.filename)
+            except OSError:
+                age = None
+            if self.registries and age is not None and age < self.refresh_seconds:
+                self.next_check = now + self.refresh_seconds - age
+                return
+            #A failed download is retried after 5 minutes
+            self.next_check = now + 300
+            self.refreshing = True
+        threading.Thread(target=self._refresh, name="rdap-bootstrap", daemon=True).start()
+
+    def _refresh(self):
+        try:
+            self.download()
+        except (requests.RequestException, OSError, BootstrapError) as e:
+            log.info(f"Unable to download the RDAP bootstrap file from {self.url}. {str(e)}")
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def base_url(self, domain):
+        """The RDAP base URL for domain or None if its TLD is not in the bootstrap file"""
+        self.check()
+        registries = self.registries
+        labels = domain.lower().rstrip(".").split(".")
+        #Longest suffix first in case an entry is more than one label
+        for start in range(1, len(labels)):
+            url = registries.get(".".join(labels[start:]))
+            if url:
+                return url
+        return None
+
+    def __len__(self):
+        return len(self.registries)
@@ -1,29 +1,260 @@
-import rdap
+import requests
+import requests.adapters
 import json
 import datetime
 import dateutil.parser
 import dateutil.tz
 import logging
+import threading
+import concurrent.futures
+import collections
+import contextlib
+import queue
+import time
+import os
+import email.utils
+
+log = logging.getLogger("domain_stats")
+
+
+class rdap_stats:
+    def __init__(self, lookups=0, errors=0, sessions=0, throttled=0, samples=10000):
+        self.lookups = lookups
+        self.errors = errors
+        self.sessions = sessions
+        #429 responses
+        self.throttled = throttled
+        #Lookup times in milliseconds for the most recent lookups
+        self.latency = collections.deque(maxlen=samples)
+
+    def percentile(self, percent):
+        latency = sorted(self.latency)
+        if not latency:
+            return 0
+        return latency[min(len(latency) - 1, int(len(latency) * percent / 100))]
+
+    def __repr__(self):
+        return (f"rdap_stats(lookups={self.lookups}, errors={self.errors}, sessions={self.sessions}, throttled={self.throttled}, "
+                f"p50_ms={self.percentile(50):.1f}, p90_ms={self.percentile(90):.1f}, p99_ms={self.percentile(99):.1f}, max_ms={self.percentile(100):.1f})")
+
+
+class RdapThrottled(Exception):
+    #The lookup was not sent, or the registry still answered 429 after the retry. Nothing was learned about the domain.
+    pass
 
 
 def retrieve_data(action_name,eventlist):
-    for entry in eventlist:
+    for entry in eventlist or []:
         if entry.get("eventAction") == action_name:
             return entry.get("eventDate")
     return None
 
-def get_domain_record(domain):
-    client = rdap.client.RdapClient()
-    client.url = "https://www.rdap.net"
-    client.timeout = 5
+def parse_date(date):
+    date = dateutil.parser.isoparse(date)
+    if not date.tzinfo:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+def retry_after(resp):
+    #Seconds from a Retry-After header, which is either seconds or an HTTP date. None if there isn't a usable one.
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
     try:
-        resp = client.get_domain(domain).data
-    except Exception as e:
-        return "ERROR","ERROR", str(e)
-    reg = retrieve_data( 'registration', resp.get('events'))
-    reg = dateutil.parser.isoparse(reg)
-    reg.replace(tzinfo=datetime.timezone.utc)
-    exp = retrieve_data( 'expiration', resp.get('events'))
-    exp = dateutil.parser.isoparse(exp)
-    exp.replace(tzinfo=datetime.timezone.utc)
-    return reg,exp,""
\ No newline at end of file
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Registry(object):
+    """The keep-alive sessions, rate limit and backoff for one RDAP server.
+       Lookups are spread by a token bucket that allows burst lookups at once and rate lookups a second after that.
+       A 429 halves the rate and holds every lookup until the Retry-After time or, without one, a delay that doubles
+       with each 429 up to a minute.  Each lookup that succeeds adds back a twentieth of the configured rate.
+       A rate of 0 is no limit. A 429 still holds lookups until the Retry-After time."""
+
+    def __init__(self, url, rate=10, burst=20, max_sessions=16):
+        self.url = url
+        self.max_rate = self.rate = rate
+        self.burst = self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.backoff = 0
+        self.lock = threading.Lock()
+        self.sessions = queue.LifoQueue(maxsize=max_sessions)
+
+    def reserve(self):
+        """Take a token. Returns the seconds to wait before sending the lookup."""
+        with self.lock:
+            now = time.monotonic()
+            if not self.max_rate:
+                return max(0, self.blocked_until - now)
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            return max(0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def cancel(self):
+        #Give back a token that reserve() took for a lookup that won't be sent
+        if self.max_rate:
+            with self.lock:
+                self.tokens += 1
+
+    def throttled(self, seconds=None):
+        with self.lock:
+            if self.max_rate:
+                self.rate = max(self.max_rate / 64, self.rate / 2)
+            self.backoff = min(60, max(1, self.backoff * 2))
+            self.blocked_until = max(self.blocked_until, time.monotonic() + (self.backoff if seconds is None else seconds))
+
+    def succeeded(self):
+        if self.rate < self.max_rate or self.backoff:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                self.backoff = self.backoff / 2 if self.backoff > 1 else 0
+
+
+class RdapEngine(object):
+    """Looks up domain registration records from RDAP servers.
+       With a bootstrap (rdap_bootstrap.RdapBootstrap) each lookup goes straight to the registry for the domain's TLD.
+       Domains whose TLD it doesn't know and every domain without one are sent to url, which redirects them.
+       Each server has its own pool of keep-alive HTTP sessions and rate limit (see Registry) and at most
+       max_concurrent lookups are sent at once. url only redirects so it is not rate limited.  Point url at a
+       local server to test without the internet."""
+
+    def __init__(self, url="https://www.rdap.net", max_concurrent=16, connect_timeout=3, read_timeout=5, bootstrap=None, registry_rate=10, registry_burst=20):
+        self.url = url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_concurrent = max_concurrent
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.bootstrap = bootstrap
+        self.registry_rate = registry_rate
+        self.registry_burst = registry_burst
+        self.registries = {}
+        self.registries_lock = threading.Lock()
+        self.pid = os.getpid()
+        self.stats = rdap_stats()
+        self.stats_lock = threading.Lock()
+
+    def registry(self, domain):
+        """The Registry that answers for domain"""
+        if os.getpid() != self.pid:
+            #Sockets must not cross a fork. Forget the parent's sessions.
+            self.registries = {}
+            self.registries_lock = threading.Lock()
+            self.pid = os.getpid()
+        url = None
+        if self.bootstrap is not None:
+            url = self.bootstrap.base_url(domain)
+        url = url or self.url
+        registry = self.registries.get(url)
+        if registry is None:
+            with self.registries_lock:
+                registry = self.registries.get(url)
+                if registry is None:
+                    rate = self.registry_rate if url != self.url else 0
+                    registry = self.registries[url] = Registry(url, rate, self.registry_burst, self.max_concurrent)
+        return registry
+
+    def _session(self):
+        session = requests.Session()
+        #rdap.net redirects to the registry so keep a few connections open per host
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=4)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["Accept"] = "application/rdap+json, application/json"
+        with self.stats_lock:
+            self.stats.sessions += 1
+        return session
+
+    @contextlib.contextmanager
+    def session(self, registry):
+        with self.slots:
+            try:
+                session = registry.sessions.get_nowait()
+            except queue.Empty:
+                session = self._session()
+            try:
+                yield session
+            finally:
+                try:
+                    registry.sessions.put_nowait(session)
+                except queue.Full:
+                    session.close()
+
+    def _get(self, registry, domain):
+        #One retry after a 429 if the registry's backoff is shorter than the read timeout
+        for attempt in range(2):
+            wait = registry.reserve()
+            if wait > self.timeout[1]:
+                registry.cancel()
+                raise RdapThrottled(f"RDAP server {registry.url} is rate limited")
+            if wait:
+                time.sleep(wait)
+            with self.session(registry) as session:
+                resp = session.get(f"{registry.url}/domain/{domain}", timeout=self.timeout)
+            if resp.status_code != 429:
+                break
+            with self.stats_lock:
+                self.stats.throttled += 1
+            registry.throttled(retry_after(resp))
+        else:
+            raise RdapThrottled(f"RDAP lookup to {resp.url} returned 429")
+        if resp.status_code == 200:
+            registry.succeeded()
+        return resp
+
+    def get_domain_record(self, domain):
+        """Returns (registration, expiration, "") or ("ERROR", "ERROR", error message). A lookup held back or refused by
+           the registry's rate limit returns ("THROTTLED", "THROTTLED", message) and should be tried again later."""
+        start = time.perf_counter()
+        try:
+            resp = self._get(self.registry(domain), domain)
+            if resp.status_code != 200:
+                raise Exception(f"RDAP lookup to {resp.url} returned {resp.status_code}")
+            events = resp.json().get('events')
+            reg = retrieve_data('registration', events)
+            exp = retrieve_data('expiration', events)
+            if not reg or not exp:
+                raise Exception(f"RDAP record for {domain} has no registration or expiration date")
+            result = parse_date(reg), parse_date(exp), ""
+        except RdapThrottled as e:
+            log.debug("RDAP lookup for %s throttled. %s", domain, e)
+            result = "THROTTLED", "THROTTLED", str(e)
+        except Exception as e:
+            log.debug("RDAP lookup for %s failed. %s", domain, e)
+            result = "ERROR", "ERROR", str(e)
+        with self.stats_lock:
+            self.stats.lookups += 1
+            if result[0] == "ERROR":
+                self.stats.errors += 1
+            self.stats.latency.append((time.perf_counter() - start) * 1000)
+        return result
+
+    def get_domain_records(self, domains):
+        """Looks up a list of domains in parallel. Returns {domain: get_domain_record(domain)}"""
+        domains = list(dict.fromkeys(domains))
+        if len(domains) <= 1:
+            return {domain: self.get_domain_record(domain) for domain in domains}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(domains), self.max_concurrent), thread_name_prefix="rdap") as executor:
+            return dict(zip(domains, executor.map(self.get_domain_record, domains)))
+
+    def close(self):
+        for registry in list(self.registries.values()):
+            while True:
+                try:
+                    registry.sessions.get_nowait().close()
+                except queue.Empty:
+                    break
+
+
+_default_engine = None
+
+def get_domain_record(domain):
+    global _default_engine
+    if not _default_engine:
+        _default_engine = RdapEngine()
+    return _default_engine.get_domain_record(domain)
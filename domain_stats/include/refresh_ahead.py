@@ -0,0 +1,78 @@
+import queue
+import threading
+import time
+import logging
+
+log = logging.getLogger("domain_stats")
+
+
+class refresh_stats:
+    def __init__(self, queued=0, dropped=0, refreshed=0, failed=0):
+        self.queued = queued
+        self.dropped = dropped
+        self.refreshed = refreshed
+        self.failed = failed
+
+    def __repr__(self):
+        return f"refresh_stats(queued={self.queued}, dropped={self.dropped}, refreshed={self.refreshed}, failed={self.failed})"
+
+
+class RefreshAhead(object):
+    """Re-resolves cache entries on a background thread before they expire so a popular domain never waits for a lookup.
+       request() is called by the cache on a hit close to expiry and only queues the key. The queue holds at most
+       max_queue keys, a key already waiting is not queued twice and keys are resolved at most per_second a second.
+       A key that arrives when the queue is full is dropped and the entry expires as it would without refresh-ahead."""
+
+    def __init__(self, resolve, max_queue=1000, per_second=10):
+        self.resolve = resolve
+        self.interval = 1 / per_second
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.stats = refresh_stats()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="refresh-ahead", daemon=True)
+        self.thread.start()
+
+    def request(self, key):
+        #Runs on the request path under the cache shard's lock. It must never block.
+        with self.lock:
+            if key in self.pending:
+                return
+            try:
+                self.queue.put_nowait(key)
+            except queue.Full:
+                self.stats.dropped += 1
+                return
+            self.pending.add(key)
+            self.stats.queued += 1
+
+    def run(self):
+        next_start = time.monotonic()
+        while not self.stopping.is_set():
+            key = self.queue.get()
+            if key is None:
+                break
+            #Pace the lookups so a burst of expiring entries does not become a burst of RDAP or ISC queries
+            delay = next_start - time.monotonic()
+            if delay > 0 and self.stopping.wait(delay):
+                break
+            next_start = max(next_start, time.monotonic()) + self.interval
+            try:
+                self.resolve(key)
+                self.stats.refreshed += 1
+            except Exception as e:
+                self.stats.failed += 1
+                log.info(f"Unable to refresh {key}. {str(e)}")
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+
+    def close(self):
+        """Stop after the current lookup. Keys still queued are forgotten."""
+        self.stopping.set()
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join()
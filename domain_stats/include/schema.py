@@ -0,0 +1,117 @@
+import datetime
+import calendar
+
+#Versions of the domains table. The version is kept in PRAGMA user_version. Databases created before it was
+#set have a user_version of 0 and are version 1.
+#  1: Every column is text. Dates are '%Y-%m-%d %H:%M:%S' strings and the LOCAL, RDAP and FIRST-CONTACT
+#     sentinels are stored in the seen_by_isc and seen_by_you date columns.
+#  2: Dates are integer seconds since the epoch (UTC). The sentinels are bits in flags and the date column they
+#     replace is 0. The table is WITHOUT ROWID so the rows are stored in the domain primary key b-tree.
+LATEST = 2
+ISC_LOCAL = 1
+ISC_RDAP = 2
+FIRST_CONTACT = 4
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+EPOCH = datetime.datetime(1970, 1, 1)
+
+CREATE_SQL = {
+    1: "CREATE TABLE domains (domain text NOT NULL UNIQUE,seen_by_web timestamp not NULL,expires timestamp not NULL,seen_by_isc timestamp not NULL,seen_by_you timestamp not NULL)",
+    2: "CREATE TABLE domains (domain text NOT NULL PRIMARY KEY,seen_by_web integer NOT NULL,expires integer NOT NULL,seen_by_isc integer NOT NULL,seen_by_you integer NOT NULL,flags integer NOT NULL) WITHOUT ROWID",
+}
+
+#The record columns in the order get_record reads them
+COLUMNS = {
+    1: "seen_by_web,expires,seen_by_isc,seen_by_you",
+    2: "seen_by_web,expires,seen_by_isc,seen_by_you,flags",
+}
+
+#SQL for each write DomainStatsDatabase makes. The parameters are built by DomainStatsDatabase.
+WRITE_SQL = {
+    1: {
+        "replace": "insert or replace into domains (domain, seen_by_web,expires,seen_by_isc,seen_by_you) values (?,?,?,?,?)",
+        "delete": "delete from domains where domain=?",
+        "touch": "update domains set seen_by_you=? where domain=?",
+        "load": "insert or ignore into domains (domain, seen_by_web,expires,seen_by_isc,seen_by_you) values (?,?,?,'LOCAL','FIRST-CONTACT')",
+        "reset": "update domains set seen_by_you='FIRST-CONTACT'",
+        "sweep": "delete from domains where domain in (select domain from domains where expires < ? limit ?)",
+    },
+    2: {
+        "replace": "insert or replace into domains (domain, seen_by_web,expires,seen_by_isc,seen_by_you,flags) values (?,?,?,?,?,?)",
+        "delete": "delete from domains where domain=?",
+        "touch": f"update domains set seen_by_you=?, flags=flags & ~{FIRST_CONTACT} where domain=?",
+        "load": f"insert or ignore into domains (domain, seen_by_web,expires,seen_by_isc,seen_by_you,flags) values (?,?,?,0,0,{ISC_LOCAL | FIRST_CONTACT})",
+        "reset": f"update domains set seen_by_you=0, flags=flags | {FIRST_CONTACT}",
+        "sweep": "delete from domains where domain in (select domain from domains where expires < ? limit ?)",
+    },
+}
+
+#Copies the local state of the live database (attached as live) into an updated shadow copy before it replaces the
+#live one. Domains resolved locally by RDAP or the ISC are added unless the copy already has them and the first
+#contact times of domains the copy still has as FIRST-CONTACT are carried over.
+MERGE_SQL = {
+    1: [
+        "insert or ignore into main.domains (domain, seen_by_web,expires,seen_by_isc,seen_by_you) select domain, seen_by_web,expires,seen_by_isc,seen_by_you from live.domains where seen_by_isc != 'LOCAL'",
+        """update main.domains set seen_by_you=(select seen_by_you from live.domains where live.domains.domain=main.domains.domain)
+           where seen_by_you='FIRST-CONTACT' and domain in (select domain from live.domains where seen_by_you != 'FIRST-CONTACT')""",
+    ],
+    2: [
+        f"insert or ignore into main.domains (domain, seen_by_web,expires,seen_by_isc,seen_by_you,flags) select domain, seen_by_web,expires,seen_by_isc,seen_by_you,flags from live.domains where flags & {ISC_LOCAL} = 0",
+        f"""update main.domains set seen_by_you=(select seen_by_you from live.domains where live.domains.domain=main.domains.domain), flags=flags & ~{FIRST_CONTACT}
+           where flags & {FIRST_CONTACT} and domain in (select domain from live.domains where flags & {FIRST_CONTACT} = 0)""",
+    ],
+}
+
+#The info table. version is the major.minor of the last update file applied. It is text because as a real "1.10" is
+#stored as 1.1. Databases created before that have a real column and INFO_TEXT_SQL converts it.
+INFO_SQL = "CREATE TABLE info (version text NOT NULL,created timestamp not NULL,lastupdate timestamp not NULL)"
+INFO_TEXT_SQL = [
+    INFO_SQL.replace("TABLE info", "TABLE info_v2"),
+    "insert into info_v2 (version, created, lastupdate) select cast(version as text), created, lastupdate from info",
+    "drop table info",
+    "alter table info_v2 rename to info",
+]
+
+#Lets the expiry sweeper find expired rows without a table scan. Text dates sort in date order too.
+EXPIRES_INDEX_SQL = "CREATE INDEX IF NOT EXISTS domains_expires ON domains (expires)"
+
+#Version 1 to 2 in place. strftime('%s') reads the text dates as UTC. A date it can't parse is NULL which fails the
+#NOT NULL constraint and rolls the migration back rather than losing the row.
+MIGRATE_SQL = [
+    CREATE_SQL[2].replace("TABLE domains", "TABLE domains_v2"),
+    f"""insert into domains_v2 (domain, seen_by_web, expires, seen_by_isc, seen_by_you, flags)
+        select domain, cast(strftime('%s', seen_by_web) as integer), cast(strftime('%s', expires) as integer),
+               case when seen_by_isc in ('LOCAL', 'RDAP') then 0 else cast(strftime('%s', seen_by_isc) as integer) end,
+               case when seen_by_you = 'FIRST-CONTACT' then 0 else cast(strftime('%s', seen_by_you) as integer) end,
+               (seen_by_isc = 'LOCAL') * {ISC_LOCAL} + (seen_by_isc = 'RDAP') * {ISC_RDAP} + (seen_by_you = 'FIRST-CONTACT') * {FIRST_CONTACT}
+        from domains order by domain""",
+    "drop table domains",
+    "alter table domains_v2 rename to domains",
+    EXPIRES_INDEX_SQL,
+    "PRAGMA user_version=2",
+]
+
+
+def version(db):
+    """The schema version of the database open on sqlite connection db"""
+    return db.execute("PRAGMA user_version").fetchone()[0] or 1
+
+def info_is_text(db):
+    """True if the info table on sqlite connection db keeps the version as text"""
+    return db.execute("select type from pragma_table_info('info') where name = 'version'").fetchone()[0].lower() == "text"
+
+def parse_version(version):
+    """(major, minor) of a database version so they compare as numbers. 1.9 is before 1.10."""
+    major, _, minor = str(version).partition(".")
+    return int(major), int(minor or 0)
+
+def to_epoch(value):
+    #Naive datetimes are UTC like the rest of domain_stats. RDAP dates are timezone aware.
+    if value.tzinfo:
+        return calendar.timegm(value.utctimetuple())
+    return calendar.timegm(value.timetuple())
+
+def from_epoch(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+def text_to_epoch(value):
+    return to_epoch(datetime.datetime.strptime(value, DATE_FORMAT))
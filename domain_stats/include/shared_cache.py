@@ -0,0 +1,182 @@
+import sqlite3
+import datetime
+import threading
+import contextlib
+import logging
+import queue
+import time
+import os
+
+log = logging.getLogger("domain_stats")
+
+
+class shared_cache_stats:
+    def __init__(self, hit=0, miss=0, insert=0, purge=0):
+        self.hit = hit
+        self.miss = miss
+        self.insert = insert
+        self.purge = purge
+
+    def __repr__(self):
+        return f"shared_cache_stats(hit={self.hit}, miss={self.miss}, insert={self.insert}, purge={self.purge})"
+
+
+class SharedCache(object):
+    """A second cache tier in a sqlite file that every server process reads and writes.
+       Expiration is stored as a wall clock (time.time()) second so it means the same thing in every process.
+       Negative values are the hours_to_live semantics of ExpiringCache (-1 never expires, -2 permanent)."""
+
+    def __init__(self, filename, max_items=1000000, pool_size=8):
+        self.filename = filename
+        self.max_items = max_items
+        self.stats = shared_cache_stats()
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.pid = os.getpid()
+        self.purge_lock = threading.Lock()
+        with self.connection() as db:
+            db.execute("create table if not exists cache (key text primary key, expires real not null, stored real not null, data blob not null) without rowid")
+            db.execute("create index if not exists cache_stored on cache(stored)")
+            db.commit()
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename, timeout=15, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        #The cache can always be rebuilt so it is never worth waiting on the disk
+        db.execute("PRAGMA synchronous=OFF")
+        return db
+
+    @contextlib.contextmanager
+    def connection(self):
+        if os.getpid() != self.pid:
+            #Connections must not cross a fork. Forget the parent's and open new ones in this process.
+            self.pool = queue.LifoQueue(maxsize=self.pool.maxsize)
+            self.pid = os.getpid()
+        try:
+            db = self.pool.get_nowait()
+        except queue.Empty:
+            db = self._connect()
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                db.rollback()
+            try:
+                self.pool.put_nowait(db)
+            except queue.Full:
+                db.close()
+
+    def __len__(self):
+        with self.connection() as db:
+            return db.execute("select count(*) from cache").fetchone()[0]
+
+    def get(self, key):
+        """Returns (data, hours_to_live remaining) or (None, 0) if the key is missing or expired"""
+        with self.connection() as db:
+            record = db.execute("select expires, data from cache where key = ?", (key,)).fetchone()
+        if record:
+            expires, data = record
+            if expires < 0:
+                self.stats.hit += 1
+                return data, int(expires)
+            remaining = expires - time.time()
+            if remaining > 0:
+                self.stats.hit += 1
+                return data, remaining / 3600
+        self.stats.miss += 1
+        return None, 0
+
+    def set(self, key, value, hours_to_live):
+        if hours_to_live == 0:
+            return
+        now = time.time()
+        expires = hours_to_live if hours_to_live < 0 else now + hours_to_live * 3600
+        with self.connection() as db:
+            db.execute("insert or replace into cache (key, expires, stored, data) values (?,?,?,?)", (key, expires, now, value))
+            db.commit()
+        self.stats.insert += 1
+        if self.stats.insert % 1000 == 0:
+            self.purge()
+
+    def purge(self):
+        """Delete expired entries then the oldest entries that can page out until there are at most max_items"""
+        if not self.purge_lock.acquire(blocking=False):
+            return
+        try:
+            with self.connection() as db:
+                purged = db.execute("delete from cache where expires >= 0 and expires < ?", (time.time(),)).rowcount
+                excess = db.execute("select count(*) from cache").fetchone()[0] - self.max_items
+                if excess > 0:
+                    purged += db.execute("delete from cache where key in (select key from cache where expires != -2 order by stored limit ?)", (excess,)).rowcount
+                db.commit()
+            self.stats.purge += purged
+        finally:
+            self.purge_lock.release()
+
+    def items(self):
+        """(key, (expires, read_count, data)) in the format used by ExpiringCache.items() and load_items()"""
+        epoch = datetime.datetime(1970, 1, 1)
+        now = time.time()
+        with self.connection() as db:
+            rows = db.execute("select key, expires, data from cache where expires < 0 or expires > ? order by stored", (now,)).fetchall()
+        return [(key, (expires if expires < 0 else epoch + datetime.timedelta(seconds=expires), 0, data)) for key, expires, data in rows]
+
+    def snapshot_entries(self):
+        """(key, expires, read_count, data) in the format used by ExpiringCache.snapshot_entries()"""
+        with self.connection() as db:
+            rows = db.execute("select key, expires, data from cache where expires < 0 or expires > ? order by stored", (time.time(),)).fetchall()
+        return [(key, expires, 0, data) for key, expires, data in rows]
+
+    def load_items(self, items):
+        epoch = datetime.datetime(1970, 1, 1)
+        now = time.time()
+        rows = []
+        for key, (expires, _, data) in items:
+            if isinstance(expires, datetime.datetime):
+                expires = (expires - epoch).total_seconds()
+            rows.append((key, expires, now, data))
+        with self.connection() as db:
+            db.executemany("insert or replace into cache (key, expires, stored, data) values (?,?,?,?)", rows)
+            db.commit()
+
+
+class TieredCache(object):
+    """Puts a SharedCache behind a process's memory cache.  A miss in the memory cache is looked up in the shared
+       tier and copied into memory.  Writes go to both so a lookup done by one process is reused by the others.
+       Everything else (stats, cache_info, cache_dump...) is the memory cache's."""
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def __getattr__(self, name):
+        return getattr(self.local, name)
+
+    def __len__(self):
+        return len(self.local)
+
+    def get(self, key, default_value=None):
+        data = self.local.get(key)
+        if data is None:
+            data = self.get_shared(key)
+        return default_value if data is None else data
+
+    def get_shared(self, key):
+        """Look a key up in the shared tier only and copy it into memory. It is a sqlite query so the asyncio server
+           checks the memory cache on the event loop and leaves this to its executor."""
+        data, hours_to_live = self.shared.get(key)
+        if data is not None:
+            self.local.set(key, data, hours_to_live=hours_to_live)
+        return data
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def set(self, key, value, update_expiration=True, reset_read_count=False, hours_to_live=None):
+        self.local.set(key, value, update_expiration, reset_read_count, hours_to_live)
+        self.shared.set(key, value, self.local.hours_to_live if hours_to_live is None else hours_to_live)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def cache_info(self):
+        return f"{self.local.cache_info()}, {self.shared.stats}"
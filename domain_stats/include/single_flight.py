@@ -0,0 +1,109 @@
+import threading
+import time
+import logging
+
+log = logging.getLogger("domain_stats")
+
+
+class single_flight_stats:
+    def __init__(self, leader=0, coalesced=0, timeout=0):
+        self.leader = leader
+        self.coalesced = coalesced
+        self.timeout = timeout
+
+    def __repr__(self):
+        return f"single_flight_stats(leader={self.leader}, coalesced={self.coalesced}, timeout={self.timeout})"
+
+
+class _call(object):
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key. The first caller (the leader) runs the function and every caller
+       that arrives while it is running waits for and shares its result instead of repeating the work."""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = single_flight_stats()
+
+    def do(self, key, function):
+        """Returns (result, shared). shared is True when the result came from another caller's call.
+           Raises TimeoutError if the leader does not finish within timeout seconds."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _call()
+                self.stats.leader += 1
+            else:
+                self.stats.coalesced += 1
+        if leader:
+            try:
+                call.result = function()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result, False
+        if not call.done.wait(self.timeout):
+            with self.lock:
+                self.stats.timeout += 1
+            raise TimeoutError(f"Timed out waiting for {key}")
+        if call.error:
+            raise call.error
+        return call.result, True
+
+    def do_many(self, keys, function):
+        """Coalesces a batch of keys. The caller leads every key that isn't already in flight in one step and
+           function(led_keys) returns a dict of their results. Keys another caller is running are waited for.
+           Returns a dict of key -> (result, shared), or a TimeoutError for a key whose leader did not finish in time."""
+        led, waiting = {}, {}
+        with self.lock:
+            for key in keys:
+                call = self.calls.get(key)
+                if call is None:
+                    led[key] = self.calls[key] = _call()
+                    self.stats.leader += 1
+                else:
+                    waiting[key] = call
+                    self.stats.coalesced += 1
+        results = {}
+        if led:
+            try:
+                led_results = function(list(led))
+                for key, call in led.items():
+                    call.result = led_results[key]
+                    results[key] = (call.result, False)
+            except BaseException as e:
+                for call in led.values():
+                    call.error = e
+                raise
+            finally:
+                with self.lock:
+                    for key in led:
+                        del self.calls[key]
+                for call in led.values():
+                    call.done.set()
+        #Every key this caller waits for was registered before its batch so two batches never wait on each other
+        deadline = time.monotonic() + self.timeout
+        for key, call in waiting.items():
+            if not call.done.wait(max(0, deadline - time.monotonic())):
+                with self.lock:
+                    self.stats.timeout += 1
+                results[key] = TimeoutError(f"Timed out waiting for {key}")
+            elif call.error:
+                raise call.error
+            else:
+                results[key] = (call.result, True)
+        return results
@@ -0,0 +1,145 @@
+import collections
+import threading
+import sqlite3
+import logging
+
+log = logging.getLogger("domain_stats")
+
+
+class WriteBehindQueue(object):
+    """A single writer thread that group commits database writes.
+       Request threads queue an operation and return immediately.  The writer drains the queue every interval_ms
+       (or as soon as max_rows are waiting) and commits the whole batch in one transaction.
+       Until a write is committed the pending row is kept in an overlay so readers still see their own writes.
+       A batch that fails with a database error is put back on the front of the queue and retried."""
+
+    def __init__(self, database, interval_ms=250, max_rows=1000, max_depth=100000):
+        self.database = database
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self.max_depth = max_depth
+        self.ops = collections.deque()
+        #domain -> (sequence number, row or None if deleted) for writes that are not committed yet
+        self.overlay = {}
+        self.queued_seq = 0
+        self.committed_seq = 0
+        self.flush_requested = False
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def put(self, op, domain, params, row):
+        """Queue an operation. row is what get_record should see for domain until it is committed (None for deletes)
+           Returns False without queueing if the writer thread has stopped so the caller writes it directly."""
+        with self.cond:
+            while len(self.ops) >= self.max_depth and self.running and self.thread.is_alive():
+                #The writer has fallen behind. Apply backpressure rather than grow without bound.
+                self.flush_requested = True
+                self.cond.notify_all()
+                self.cond.wait(self.interval)
+            if not self.thread.is_alive():
+                #Nothing will commit a queued write. The caller's direct write must not be hidden by an older pending row.
+                self.overlay.pop(domain, None)
+                return False
+            self.queued_seq += 1
+            self.ops.append((self.queued_seq, op, domain, params))
+            self.overlay[domain] = (self.queued_seq, row)
+            self.database.stats.write_queue = len(self.ops)
+            if len(self.ops) >= self.max_rows:
+                self.cond.notify_all()
+        return True
+
+    def lookup(self, domain):
+        """Returns (True, row) if a write for domain is pending otherwise (False, None)"""
+        with self.cond:
+            pending = self.overlay.get(domain)
+        if pending:
+            return True, pending[1]
+        return False, None
+
+    def run(self):
+        failures = 0
+        while True:
+            with self.cond:
+                if self.running and not self.flush_requested and len(self.ops) < self.max_rows:
+                    self.cond.wait(self.interval)
+                if not self.ops:
+                    self.flush_requested = False
+                    if not self.running:
+                        break
+                    continue
+                batch = [self.ops.popleft() for _ in range(min(len(self.ops), self.max_rows))]
+                if not self.ops:
+                    self.flush_requested = False
+            try:
+                self.write_batch(batch)
+                failures = 0
+            except sqlite3.Error as e:
+                failures += 1
+                with self.cond:
+                    if self.running:
+                        #Put the batch back in order and wait longer after each failure. Its rows stay in the overlay.
+                        self.ops.extendleft(reversed(batch))
+                        self.database.stats.write_queue = len(self.ops)
+                        log.error(f"Write behind batch of {len(batch)} rows failed and will be retried. {str(e)}")
+                        self.cond.wait(min(self.interval * 2 ** failures, 30))
+                        continue
+                #Closing. Each remaining batch gets one more try so close() doesn't wait forever on a broken database.
+                self.discard(batch, f"failed while closing and was discarded. {str(e)}")
+            except Exception as e:
+                #Retrying can't fix anything else. Drop the batch but keep the writer running.
+                log.exception(f"Write behind batch of {len(batch)} rows raised an unexpected error.")
+                self.discard(batch, f"was discarded. {str(e)}")
+
+    def write_batch(self, batch):
+        """Commit the batch in one transaction. If it raises connection() rolls it back and the overlay is unchanged."""
+        inserts = deletes = 0
+        with self.database.connection() as db, self.database.lock:
+            write_sql = self.database.write_sql
+            for _, op, _, params in batch:
+                db.execute(write_sql[op], params)
+                if op == "replace":
+                    inserts += 1
+                elif op == "delete":
+                    deletes += 1
+            db.commit()
+        with self.cond:
+            self.finish(batch)
+            stats = self.database.stats
+            stats.insert += inserts
+            stats.delete += deletes
+            stats.write_batches += 1
+            stats.write_rows += len(batch)
+            stats.write_max_batch = max(stats.write_max_batch, len(batch))
+
+    def discard(self, batch, reason):
+        log.error(f"Write behind batch of {len(batch)} rows {reason}")
+        with self.cond:
+            self.finish(batch)
+
+    def finish(self, batch):
+        #Called with cond held once the batch is committed or given up on
+        for seq, _, domain, _ in batch:
+            pending = self.overlay.get(domain)
+            if pending and pending[0] == seq:
+                del self.overlay[domain]
+        self.committed_seq = batch[-1][0]
+        self.database.stats.write_queue = len(self.ops)
+        self.cond.notify_all()
+
+    def flush(self):
+        """Block until everything queued before the call is committed"""
+        with self.cond:
+            target = self.queued_seq
+            while self.committed_seq < target and self.thread.is_alive():
+                self.flush_requested = True
+                self.cond.notify_all()
+                self.cond.wait(self.interval)
+
+    def close(self):
+        """Commit everything that is queued and stop the writer thread"""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
@@ -0,0 +1,36 @@
+import importlib.machinery
+import importlib.util
+import logging
+import pathlib
+import sys
+import pytest
+
+#The tests import include.* the way the domain_stats and database_admin scripts do
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture
+def server():
+    """The domain_stats script loaded as a module. Its globals are set up by main so each test sets the ones it uses."""
+    loader = importlib.machinery.SourceFileLoader("domain_stats_server", str(ROOT / "domain_stats"))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    module.log = logging.getLogger("domain_stats")
+    return module
+
+
+@pytest.fixture
+def stub_rdap():
+    """Starts benchmarks/stub_rdap.py servers on free ports. Call it with start()'s arguments. Returns the server."""
+    import benchmarks.stub_rdap as stub
+    servers = []
+    def start(**kwargs):
+        server = stub.start(port=0, delay_ms=0, **kwargs)
+        servers.append(server)
+        server.url = f"http://127.0.0.1:{server.server_address[1]}"
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,22 @@
+import include.compact_response as compact_response
+import include.expiring_cache as expiring_cache
+import include.metrics as metrics
+import include.shared_cache as shared_cache
+
+
+def test_shared_tier_is_read_in_the_executor(tmp_path, server):
+    server.shared = shared_cache.SharedCache(str(tmp_path / "domain_stats.shared_cache"))
+    server.cache = shared_cache.TieredCache(expiring_cache.ExpiringCache(100), server.shared)
+    server.request_metrics = metrics.RequestMetrics()
+    data = compact_response.pack("ERROR", "ERROR", "ERROR", "ERROR", [])
+    #Another worker process resolved the domain
+    server.shared.set("example.com", data, 1)
+    server.shared.stats.hit = server.shared.stats.miss = 0
+    result = server.async_lookup("example.com")
+    #The event loop gets a function and did not query the shared tier
+    assert callable(result)
+    assert server.shared.stats.hit == server.shared.stats.miss == 0
+    assert result() == compact_response.render(data)
+    assert server.shared.stats.hit == 1
+    #Now it is in this process's memory and is answered on the event loop
+    assert server.async_lookup("example.com") == compact_response.render(data)
@@ -0,0 +1,90 @@
+import datetime
+import json
+import threading
+import time
+import include.database_io as database_io
+import include.expiring_cache as expiring_cache
+import include.metrics as metrics
+import include.single_flight as single_flight
+
+REGISTERED = datetime.datetime(2010, 1, 1, tzinfo=datetime.timezone.utc)
+EXPIRES = datetime.datetime(2999, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class BlockingRdap(object):
+    """Stands in for RdapEngine. Single lookups wait until released so a batch can arrive while one is running."""
+    def __init__(self):
+        self.single = []
+        self.batches = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def get_domain_record(self, domain):
+        self.single.append(domain)
+        self.entered.set()
+        self.release.wait(5)
+        return REGISTERED, EXPIRES, ""
+
+    def get_domain_records(self, domains):
+        self.batches.append(list(domains))
+        return {domain: (REGISTERED, EXPIRES, "") for domain in domains}
+
+
+def rdap_server(tmp_path, server):
+    filename = str(tmp_path / "domain_stats.db")
+    database_io.DomainStatsDatabase(filename).create_file(filename)
+    server.config = {"mode": "rdap", "timezone_offset": 0}
+    server.database = database_io.DomainStatsDatabase(filename)
+    server.cache = expiring_cache.ExpiringCache(100)
+    server.coalescer = single_flight.SingleFlight(5)
+    server.request_metrics = metrics.RequestMetrics()
+    server.rdap_engine = BlockingRdap()
+    return server
+
+
+def test_batch_waits_for_a_get_already_resolving_a_domain(tmp_path, server):
+    server = rdap_server(tmp_path, server)
+    single = []
+    get = threading.Thread(target=lambda: single.append(server.domain_stats("racing.com")))
+    get.start()
+    assert server.rdap_engine.entered.wait(5)
+    batch = []
+    post = threading.Thread(target=lambda: batch.extend(server.batch_domain_stats(["racing.com", "other.com"])))
+    post.start()
+    #Let the GET finish once the batch is waiting on it
+    deadline = time.monotonic() + 5
+    while server.coalescer.stats.coalesced < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    server.rdap_engine.release.set()
+    get.join(5)
+    post.join(5)
+    #racing.com was looked up once and only the GET reported the first contact
+    assert server.rdap_engine.single == ["racing.com"]
+    assert server.rdap_engine.batches == [["other.com"]]
+    assert json.loads(single[0])["alerts"] == ["YOUR-FIRST-CONTACT"]
+    assert json.loads(batch[0])["alerts"] == []
+    assert json.loads(batch[1])["alerts"] == ["YOUR-FIRST-CONTACT"]
+    server.database.close()
+
+
+def test_get_waits_for_a_batch_resolving_a_domain(tmp_path, server):
+    server = rdap_server(tmp_path, server)
+    leading = threading.Event()
+    get_records = server.database.get_records
+    def slow_get_records(domains):
+        #The batch has registered its misses before it reads the database
+        leading.set()
+        time.sleep(0.2)
+        return get_records(domains)
+    server.database.get_records = slow_get_records
+    batch = []
+    post = threading.Thread(target=lambda: batch.extend(server.batch_domain_stats(["racing.com"])))
+    post.start()
+    assert leading.wait(5)
+    single = server.domain_stats("racing.com")
+    post.join(5)
+    assert server.rdap_engine.single == []
+    assert server.rdap_engine.batches == [["racing.com"]]
+    assert json.loads(batch[0])["alerts"] == ["YOUR-FIRST-CONTACT"]
+    assert json.loads(single)["alerts"] == []
+    server.database.close()
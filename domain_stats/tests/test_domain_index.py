@@ -0,0 +1,43 @@
+import datetime
+import include.database_io as database_io
+import include.domain_index as domain_index
+
+
+def test_index_dropped_when_another_process_resets_first_contacts(tmp_path):
+    filename = str(tmp_path / "domain_stats.db")
+    index_file = str(tmp_path / "domain_stats.idx")
+    admin = database_io.DomainStatsDatabase(filename)
+    admin.create_file(filename)
+    admin = database_io.DomainStatsDatabase(filename)
+    web = datetime.datetime(2010, 1, 1)
+    expires = datetime.datetime.utcnow() + datetime.timedelta(days=365)
+    admin.update_record("example.com", web, expires, "LOCAL", datetime.datetime(2020, 1, 1))
+    admin.compile_index(index_file)
+    #The server's view of the same database in another process
+    server = database_io.DomainStatsDatabase(filename)
+    assert server.open_index(index_file, check_seconds=0)
+    assert server.get_record("example.com")[3] == datetime.datetime(2020, 1, 1)
+    assert server.stats.index_hit == 1
+    admin.reset_first_contact()
+    assert server.get_record("example.com")[3] == "FIRST-CONTACT"
+    assert server.index is None
+    admin.close()
+    server.close()
+
+
+def test_index_tells_minor_1_from_10(tmp_path):
+    filename = str(tmp_path / "domain_stats.db")
+    index_file = str(tmp_path / "domain_stats.idx")
+    database_io.DomainStatsDatabase(filename).create_file(filename)
+    database = database_io.DomainStatsDatabase(filename)
+    with database.connection() as db:
+        db.execute("update info set version='1.10'")
+        db.commit()
+    database = database_io.DomainStatsDatabase(filename)
+    database.compile_index(index_file)
+    index = domain_index.DomainIndex(index_file)
+    assert index.version == "1.10"
+    assert index.matches("1.10", database.lastupdate)
+    assert not index.matches("1.1", database.lastupdate)
+    index.close()
+    database.close()
@@ -0,0 +1,34 @@
+import datetime
+import include.database_io as database_io
+
+
+def expired_database(tmp_path):
+    filename = str(tmp_path / "domain_stats.db")
+    database_io.DomainStatsDatabase(filename).create_file(filename)
+    database = database_io.DomainStatsDatabase(filename)
+    web = datetime.datetime(2010, 1, 1)
+    database.update_record("expired.com", web, datetime.datetime(2020, 1, 1), "LOCAL", datetime.datetime(2015, 1, 1))
+    return database
+
+
+def rows(database):
+    with database.connection() as db:
+        return db.execute("select count(*) from domains").fetchone()[0]
+
+
+def test_lookup_deletes_expired_domain_without_sweeper(tmp_path):
+    database = expired_database(tmp_path)
+    assert database.get_record("expired.com") == (None, None, None, None)
+    assert rows(database) == 0
+    database.close()
+
+
+def test_lookup_leaves_expired_domain_to_sweeper(tmp_path):
+    database = expired_database(tmp_path)
+    database.start_sweeper(interval_minutes=60)
+    database.sweeper.close()
+    database.update_record("expired.com", datetime.datetime(2010, 1, 1), datetime.datetime(2020, 1, 1), "LOCAL", datetime.datetime(2015, 1, 1))
+    assert database.get_record("expired.com") == (None, None, None, None)
+    assert rows(database) == 1
+    assert database.sweep_expired() == 1
+    database.close()
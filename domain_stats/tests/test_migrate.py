@@ -0,0 +1,41 @@
+import datetime
+import subprocess
+import sys
+import pytest
+import include.database_io as database_io
+import include.schema as schema
+
+
+def version1_database(tmp_path):
+    filename = str(tmp_path / "domain_stats.db")
+    database_io.DomainStatsDatabase(filename).create_file(filename, schema_version=1)
+    database = database_io.DomainStatsDatabase(filename)
+    database.update_record("example.com", datetime.datetime(2010, 1, 1), datetime.datetime(2999, 1, 1), "LOCAL", "FIRST-CONTACT")
+    return database
+
+
+def test_migrate_touches_lastupdate(tmp_path):
+    database = version1_database(tmp_path)
+    lastupdate = database.lastupdate
+    assert database.migrate() == 1
+    assert database.schema == schema.LATEST
+    assert str(database.lastupdate) != str(lastupdate)
+    assert database.get_record("example.com")[3] == "FIRST-CONTACT"
+    database.close()
+
+
+def test_migrate_refuses_while_open_elsewhere(tmp_path):
+    database = version1_database(tmp_path)
+    #A server in another process with the database open
+    server = subprocess.Popen([sys.executable, "-c", "import sqlite3,sys;db=sqlite3.connect(sys.argv[1]);db.execute('PRAGMA journal_mode=WAL');"
+                               "db.execute('select count(*) from domains').fetchone();print('open',flush=True);sys.stdin.read()", database.filename],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        assert server.stdout.readline().strip() == "open"
+        with pytest.raises(Exception, match="open in another process"):
+            database.migrate()
+        assert database.schema == 1
+    finally:
+        server.communicate("")
+    assert database.migrate() == 1
+    database.close()
@@ -0,0 +1,45 @@
+import datetime
+import include.rdap_query as rdap_query
+
+
+def test_lookup(stub_rdap):
+    engine = rdap_query.RdapEngine(stub_rdap().url)
+    registered, expires, error = engine.get_domain_record("example.com")
+    assert error == ""
+    assert registered.utcoffset() == datetime.timedelta(0)
+    assert registered < datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) < expires
+    #The stub always gives a domain the same dates
+    assert engine.get_domain_record("example.com") == (registered, expires, "")
+    assert engine.stats.lookups == 2
+    assert engine.stats.errors == 0
+    engine.close()
+
+
+def test_sessions_are_reused(stub_rdap):
+    engine = rdap_query.RdapEngine(stub_rdap().url, max_concurrent=4)
+    for n in range(10):
+        engine.get_domain_record(f"domain{n}.com")
+    assert engine.stats.sessions == 1
+    records = engine.get_domain_records([f"parallel{n}.com" for n in range(40)])
+    assert len(records) == 40
+    assert all(error == "" for _, _, error in records.values())
+    #No more sessions than lookups at once
+    assert engine.stats.sessions <= 4
+    engine.close()
+
+
+def test_error_response_is_an_error(stub_rdap):
+    engine = rdap_query.RdapEngine(stub_rdap(error_rate=1.0).url)
+    web, expires, error = engine.get_domain_record("example.com")
+    assert (web, expires) == ("ERROR", "ERROR")
+    assert "returned 404" in error
+    assert engine.stats.errors == 1
+    engine.close()
+
+
+def test_unreachable_server_is_an_error():
+    engine = rdap_query.RdapEngine("http://127.0.0.1:9", connect_timeout=1, read_timeout=1)
+    web, expires, error = engine.get_domain_record("example.com")
+    assert (web, expires) == ("ERROR", "ERROR")
+    assert error
+    engine.close()
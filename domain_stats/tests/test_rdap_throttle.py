@@ -0,0 +1,71 @@
+import json
+import time
+import benchmarks.stub_rdap as stub
+import include.expiring_cache as expiring_cache
+import include.rdap_bootstrap as rdap_bootstrap
+import include.rdap_query as rdap_query
+
+
+def registry_engine(tmp_path, port, **kwargs):
+    #.com goes to the registry on port. Everything else goes to rdap_url.
+    filename = tmp_path / "rdap_dns.json"
+    filename.write_text(json.dumps(stub.bootstrap_file([port], tlds=("com",))))
+    bootstrap = rdap_bootstrap.RdapBootstrap(str(filename))
+    return rdap_query.RdapEngine("http://localhost:9", bootstrap=bootstrap, **kwargs)
+
+
+def throttled_engine(tmp_path):
+    #Nothing listens on the discard port. The empty token bucket stops the lookup before it is sent.
+    engine = registry_engine(tmp_path, 9, read_timeout=1, registry_rate=0.01, registry_burst=1)
+    engine.registry("example.com").tokens = 0
+    return engine
+
+
+def test_rate_limited_lookup_is_throttled_not_an_error(tmp_path):
+    engine = throttled_engine(tmp_path)
+    web, expires, message = engine.get_domain_record("example.com")
+    assert (web, expires) == ("THROTTLED", "THROTTLED")
+    assert "rate limited" in message
+    assert engine.stats.errors == 0
+
+
+def test_throttled_lookup_is_not_cached(tmp_path, server):
+    server.config = {"mode": "rdap", "timezone_offset": 0}
+    server.cache = expiring_cache.ExpiringCache(100)
+    server.rdap_engine = throttled_engine(tmp_path)
+    resp, cache_resp, tier = server.resolve_record("example.com", (None, None, None, None))
+    assert tier == "error"
+    assert json.loads(resp)["seen_by_web"] == "ERROR"
+    assert server.cache.get("example.com") is None
+
+
+def test_rdap_url_is_not_rate_limited(stub_rdap):
+    engine = rdap_query.RdapEngine(stub_rdap().url, registry_rate=1, registry_burst=1)
+    records = engine.get_domain_records([f"domain{n}.com" for n in range(40)])
+    assert all(web not in ("ERROR", "THROTTLED") for web, _, _ in records.values())
+    engine.close()
+
+
+def test_429_backs_off_until_retry_after(tmp_path, stub_rdap):
+    registry = stub_rdap(rate_limit=3)
+    engine = registry_engine(tmp_path, registry.server_address[1], registry_rate=100, registry_burst=100)
+    start = time.monotonic()
+    records = [engine.get_domain_record(f"domain{n}.com") for n in range(8)]
+    #The stub answers 429 with Retry-After: 1 after 3 lookups in a second. The retry waits for it and succeeds.
+    assert all(web not in ("ERROR", "THROTTLED") for web, _, _ in records)
+    assert engine.stats.throttled >= 1
+    assert time.monotonic() - start >= 1
+    assert engine.registry("domain0.com").rate < 100
+    engine.close()
+
+
+def test_registry_recovers_after_429():
+    registry = rdap_query.Registry("http://127.0.0.1:9", rate=20, burst=20)
+    registry.throttled(0)
+    registry.throttled(0)
+    assert registry.rate == 5
+    assert registry.backoff == 2
+    for _ in range(15):
+        registry.succeeded()
+    assert registry.rate == 20
+    assert registry.backoff == 0
@@ -0,0 +1,42 @@
+import datetime
+import json
+import include.database_io as database_io
+import include.expiring_cache as expiring_cache
+import include.metrics as metrics
+import include.single_flight as single_flight
+
+
+def new_database(tmp_path):
+    filename = str(tmp_path / "domain_stats.db")
+    database = database_io.DomainStatsDatabase(filename)
+    database.create_file(filename)
+    return database_io.DomainStatsDatabase(filename)
+
+
+def test_peek_leaves_first_contact(tmp_path):
+    database = new_database(tmp_path)
+    web = datetime.datetime(2010, 1, 1)
+    expires = datetime.datetime.utcnow() + datetime.timedelta(days=365)
+    database.update_record("example.com", web, expires, "LOCAL", "FIRST-CONTACT")
+    assert database.get_record("example.com", peek=True)[3] == "FIRST-CONTACT"
+    assert database.get_record("example.com")[3] == "FIRST-CONTACT"
+    assert isinstance(database.get_record("example.com")[3], datetime.datetime)
+    database.close()
+
+
+def test_refresh_keeps_first_contact(tmp_path, server):
+    server.database = new_database(tmp_path)
+    server.config = {"timezone_offset": 0}
+    server.cache = expiring_cache.ExpiringCache(100)
+    server.coalescer = single_flight.SingleFlight()
+    server.request_metrics = metrics.RequestMetrics()
+    web = datetime.datetime(2010, 1, 1)
+    expires = datetime.datetime.utcnow() + datetime.timedelta(days=365)
+    server.database.update_record("example.com", web, expires, "LOCAL", "FIRST-CONTACT")
+    #A background refresh of the domain must not use up its first contact
+    server.refresh_domain("example.com")
+    response = json.loads(server.domain_stats("example.com"))
+    assert response["alerts"] == ["YOUR-FIRST-CONTACT"]
+    response = json.loads(server.domain_stats("example.com"))
+    assert response["alerts"] == []
+    server.database.close()
@@ -0,0 +1,37 @@
+import sqlite3
+import pytest
+import include.database_io as database_io
+import include.schema as schema
+
+
+def write_updates(folder, major, minors):
+    #One new domain in each update file
+    (folder / f"{major}").mkdir(parents=True)
+    for minor in minors:
+        (folder / f"{major}" / f"{minor}.txt").write_text(f"+,update{minor}.com,2000-01-01 00:00:00,2999-01-01 00:00:00\n")
+
+
+@pytest.mark.parametrize("real_version", [False, True])
+def test_update_from_minor_9_to_10(tmp_path, monkeypatch, real_version):
+    #Downloaded update files are kept in ./data
+    monkeypatch.chdir(tmp_path)
+    write_updates(tmp_path / "updates", 1, range(1, 11))
+    filename = str(tmp_path / "domain_stats.db")
+    database_io.DomainStatsDatabase(filename).create_file(filename)
+    if real_version:
+        #Databases created before the version was text
+        db = sqlite3.connect(filename)
+        db.executescript("drop table info; CREATE TABLE info (version real NOT NULL,created timestamp not NULL,lastupdate timestamp not NULL);"
+                         "insert into info values (1.0, '2020-01-01 00:00:00', '2020-01-01 00:00:00');")
+        db.close()
+    database = database_io.DomainStatsDatabase(filename)
+    assert database.update_database("1.9", str(tmp_path / "updates")) == ("1.9", 9)
+    assert database.update_database("1.10", str(tmp_path / "updates")) == ("1.10", 1)
+    database.close()
+    database = database_io.DomainStatsDatabase(filename)
+    assert schema.parse_version(database.version) == (1, 10)
+    assert schema.parse_version(database.version) > schema.parse_version("1.9")
+    #Nothing is left to apply
+    assert database.update_database("1.10", str(tmp_path / "updates")) == ("1.10", 0)
+    assert database.get_record("update10.com")[0] is not None
+    database.close()
@@ -0,0 +1,89 @@
+import datetime
+import threading
+import pytest
+import include.database_io as database_io
+import include.public_suffix as public_suffix
+import include.schema as schema
+from conftest import ROOT
+
+#Update files shipped with the repository
+DATA = ROOT.parent / "data" / "1"
+
+
+def write_mixed(path):
+    #Adds, deletes and adds again so the order of + and - matters
+    lines = []
+    for i in range(300):
+        lines.append(f"+,mixed{i}.com,2001-01-01 00:00:00,2999-01-01 00:00:00")
+    for i in range(0, 300, 3):
+        lines.append(f"-,mixed{i}.com,2001-01-01 00:00:00,2999-01-01 00:00:00")
+    for i in range(0, 300, 6):
+        lines.append(f"+,mixed{i}.com,2002-02-02 00:00:00,2998-01-01 00:00:00")
+    #A second add of a record that exists keeps the first one
+    lines.append("+,mixed1.com,2003-03-03 00:00:00,2997-01-01 00:00:00")
+    path.write_text("\n".join(lines) + "\n")
+    return path
+
+
+def apply_row_by_row(database, update_file):
+    #The reference. One record at a time through update_record and delete_record.
+    for line in filter(None, map(str.strip, update_file.read_text().splitlines())):
+        command, domain, web, expires = line.split(",")
+        domain = public_suffix.reduce_domain(domain)
+        if command == "+":
+            with database.connection() as db:
+                exists = db.execute("select 1 from domains where domain=?", (domain,)).fetchone()
+            if not exists:
+                database.update_record(domain, datetime.datetime.fromisoformat(web), datetime.datetime.fromisoformat(expires), "LOCAL", "FIRST-CONTACT")
+        elif command == "-":
+            database.delete_record(domain)
+
+
+def table(database):
+    with database.connection() as db:
+        return db.execute("select * from domains order by domain").fetchall()
+
+
+@pytest.mark.parametrize("schema_version", [1, schema.LATEST])
+@pytest.mark.parametrize("defer_indexes", [False, True])
+def test_batched_import_matches_row_by_row(tmp_path, schema_version, defer_indexes):
+    update_files = [DATA / "1.txt", DATA / "2.txt", write_mixed(tmp_path / "mixed.txt")]
+    databases = []
+    for name in ("batched.db", "reference.db"):
+        filename = str(tmp_path / name)
+        database_io.DomainStatsDatabase(filename).create_file(filename, schema_version)
+        databases.append(database_io.DomainStatsDatabase(filename))
+    batched, reference = databases
+    for update_file in update_files:
+        #A small chunk size so chunks end in the middle of runs of + and -
+        batched.process_update_file(str(update_file), chunk_rows=97, defer_indexes=defer_indexes)
+        apply_row_by_row(reference, update_file)
+    rows = table(batched)
+    assert len(rows) > 4000
+    assert rows == table(reference)
+    with batched.connection() as db:
+        assert db.execute("select count(*) from sqlite_master where type='index' and name='domains_expires'").fetchone()[0] == 1
+    batched.close()
+    reference.close()
+
+
+def test_lock_released_between_chunks(tmp_path, monkeypatch):
+    filename = str(tmp_path / "domain_stats.db")
+    database_io.DomainStatsDatabase(filename).create_file(filename)
+    database = database_io.DomainStatsDatabase(filename)
+    lookup = threading.Thread(target=database.update_record, args=("lookup.com", datetime.datetime(2001,1,1), datetime.datetime(2999,1,1), "RDAP", "FIRST-CONTACT"))
+    finished_during_load = []
+    parse = database._parse_update_line
+    def parse_and_watch(entry):
+        #Once the load is under way a lookup on another thread writes a record. It must not wait for the whole file.
+        if not lookup.is_alive() and not lookup.ident:
+            lookup.start()
+        elif lookup.ident and not lookup.is_alive():
+            finished_during_load.append(True)
+        return parse(entry)
+    monkeypatch.setattr(database, "_parse_update_line", parse_and_watch)
+    database.process_update_file(str(DATA / "2.txt"), chunk_rows=10)
+    lookup.join(timeout=5)
+    assert finished_during_load
+    assert database.get_record("lookup.com")[0] is not None
+    database.close()
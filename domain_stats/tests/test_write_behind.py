@@ -0,0 +1,91 @@
+import datetime
+import sqlite3
+import threading
+import include.database_io as database_io
+
+WEB = datetime.datetime(2010, 1, 1)
+EXPIRES = datetime.datetime(2999, 1, 1)
+
+
+def write_behind_database(tmp_path):
+    filename = str(tmp_path / "domain_stats.db")
+    database_io.DomainStatsDatabase(filename).create_file(filename)
+    database = database_io.DomainStatsDatabase(filename)
+    database.start_write_behind(interval_ms=10)
+    return database
+
+
+def stored(database, domain):
+    with database.connection() as db:
+        return db.execute("select count(*) from domains where domain=?", (domain,)).fetchone()[0]
+
+
+def test_failed_batch_is_retried_and_stays_visible(tmp_path, monkeypatch):
+    database = write_behind_database(tmp_path)
+    write_batch = database.writer.write_batch
+    failures = []
+    def failing_write_batch(batch):
+        #The database is busy for the first few attempts
+        if len(failures) < 3:
+            failures.append(batch)
+            raise sqlite3.OperationalError("database is locked")
+        write_batch(batch)
+    monkeypatch.setattr(database.writer, "write_batch", failing_write_batch)
+    database.update_record("retried.com", WEB, EXPIRES, "RDAP", "FIRST-CONTACT")
+    database.writer.flush()
+    assert len(failures) == 3
+    assert stored(database, "retried.com") == 1
+    assert database.get_record("retried.com")[0] is not None
+    database.close()
+
+
+def test_overlay_kept_until_commit(tmp_path, monkeypatch):
+    database = write_behind_database(tmp_path)
+    attempted = threading.Event()
+    def failing_write_batch(batch):
+        attempted.set()
+        raise sqlite3.OperationalError("disk I/O error")
+    monkeypatch.setattr(database.writer, "write_batch", failing_write_batch)
+    database.update_record("pending.com", WEB, EXPIRES, "RDAP", "FIRST-CONTACT")
+    assert attempted.wait(5)
+    assert stored(database, "pending.com") == 0
+    assert database.get_record("pending.com", peek=True)[0] is not None
+    #Closing gives up on it so close() returns
+    database.close()
+
+
+def test_unexpected_error_does_not_stop_writer(tmp_path, monkeypatch):
+    database = write_behind_database(tmp_path)
+    write_batch = database.writer.write_batch
+    calls = []
+    def broken_once(batch):
+        calls.append(batch)
+        if len(calls) == 1:
+            raise RuntimeError("bug")
+        write_batch(batch)
+    monkeypatch.setattr(database.writer, "write_batch", broken_once)
+    database.update_record("dropped.com", WEB, EXPIRES, "RDAP", "FIRST-CONTACT")
+    database.writer.flush()
+    database.update_record("later.com", WEB, EXPIRES, "RDAP", "FIRST-CONTACT")
+    database.writer.flush()
+    assert database.writer.thread.is_alive()
+    assert stored(database, "later.com") == 1
+    database.close()
+
+
+def test_put_writes_directly_when_writer_has_stopped(tmp_path):
+    database = write_behind_database(tmp_path)
+    writer = database.writer
+    #Stop the thread as if it had died with the queue full and an older write for the domain pending
+    writer.close()
+    writer.running = True
+    writer.max_depth = 1
+    writer.ops.append((1, "replace", "stuck.com", ()))
+    writer.overlay["direct.com"] = (1, None)
+    done = threading.Thread(target=database.update_record, args=("direct.com", WEB, EXPIRES, "RDAP", "FIRST-CONTACT"))
+    done.start()
+    done.join(timeout=5)
+    assert not done.is_alive()
+    assert stored(database, "direct.com") == 1
+    assert database.get_record("direct.com", peek=True)[0] is not None
+    database.close()
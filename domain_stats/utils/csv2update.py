@@ -1,6 +1,8 @@
 import csv
 import sqlite3
 import datetime
+#Share the server's domain normalization. Run it from the domain_stats directory (python -m utils.csv2update) so include is found like it is for the domain_stats script.
+from include.public_suffix import reduce_domain
 
 
 #domain, web_born_on, web_expires, Rank, seen_by_you   
@@ -8,21 +10,6 @@ import datetime
 filename="sample_com_v30_full_1000.csv"
 update_file = "1.0.csv"
 
-def reduce_domain(domain_in):
-    parts =  domain_in.strip().split(".")
-    if len(parts)> 2: 
-        if parts[-1] not in ['com','org','net','gov','edu']:
-            if parts[-2] in ['co', 'com','ne','net','or','org','go','gov','ed','edu','ac','ad','gr','lg','mus','gouv']:
-                domain = ".".join(parts[-3:])
-            else:
-                domain = ".".join(parts[-2:])
-        else:
-            domain = ".".join(parts[-2:])
-            #print("trim top part", domain_in, domain)
-    else:
-        domain = ".".join(parts)
-    return domain.lower()
-
 
 with open(filename) as fhandle, open(update_file,"w") as uhandle:
     csvreader = csv.DictReader(fhandle)
@@ -6,6 +6,8 @@ import threading
 import socket
 import json
 import logging
+#Share the server's domain normalization. Run it from the domain_stats directory (python -m utils.dstat_utils) so include is found like it is for the domain_stats script.
+from include.public_suffix import reduce_domain
 
 
 
@@ -23,21 +25,6 @@ def get_creation_date(whois_record, debug=False):
         return False
     return datetime_object
 
-def reduce_domain(domain_in):
-    parts =  domain_in.strip().split(".")
-    if len(parts)> 2: 
-        if parts[-1] not in ['com','org','net','gov','edu']:
-            if parts[-2] in ['co', 'com','ne','net','or','org','go','gov','ed','edu','ac','ad','gr','lg','mus','gouv']:
-                domain = ".".join(parts[-3:])
-            else:
-                domain = ".".join(parts[-2:])
-        else:
-            domain = ".".join(parts[-2:])
-            #print("trim top part", domain_in, domain)
-    else:
-        domain = ".".join(parts)
-    return domain.lower()
-
 def get_db():
     db =  sqlite3.connect(config.database_file, timeout=15)
     return db
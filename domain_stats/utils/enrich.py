@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#Adds domain_stats data to the domains in log files without going through the web API.
+#Domains are read from a file of domains, a column of a delimited log or the query field of a Zeek dns.log (plain or
+#gzipped, or stdin), reduced like the server reduces them and resolved by worker processes reading the database
+#directly.  Each window of lines is deduplicated and one record per distinct domain is written with the number of
+#times it appeared in that window.  Memory use is bounded by the window size no matter how large the input is.
+#  python utils/enrich.py -d domain_stats.db dns.log.gz -o enriched.jsonl
+#  zcat conn*.log.gz | python utils/enrich.py -d domain_stats.db --column 9 --format csv
+import argparse
+import collections
+import csv
+import datetime
+import gzip
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import pathlib
+import sys
+import time
+#Share the server's domain normalization and database code
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import include.database_io as database_io
+import include.public_suffix as public_suffix
+import include.rdap_query as rdap_query
+
+CSV_FIELDS = ["domain", "count", "seen_by_web", "seen_by_isc", "seen_by_you", "category", "alerts"]
+
+#Set in each worker process by init_worker
+database = None
+rdap_engine = None
+output_format = "jsonl"
+
+
+def dateconverter(o):
+    if isinstance(o, datetime.datetime):
+        return o.strftime("%Y-%m-%d %H:%M:%S")
+
+def utc(value):
+    #RDAP dates are timezone aware. Everything else in domain_stats is naive UTC.
+    if isinstance(value, datetime.datetime) and value.tzinfo:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+def open_input(name):
+    fh = sys.stdin.buffer if name == "-" else open(name, "rb")
+    if fh.peek(2)[:2] == b"\x1f\x8b":
+        fh = gzip.GzipFile(fileobj=fh)
+    return io.TextIOWrapper(fh, encoding="utf-8", errors="replace")
+
+def read_domains(filenames, column=None, delimiter=None, field=None):
+    #Yields the domain from each line. A Zeek log's #separator and #fields headers pick the delimiter and column.
+    for filename in filenames:
+        line_delimiter, line_column = delimiter, column
+        with open_input(filename) as fh:
+            for line in fh:
+                if line.startswith("#"):
+                    if line.startswith("#separator"):
+                        line_delimiter = line.split(None, 1)[1].strip().encode().decode("unicode_escape")
+                    elif line.startswith("#fields") and column is None:
+                        fields = line.rstrip("\n").split(line_delimiter or "\t")[1:]
+                        if (field or "query") in fields:
+                            line_column = fields.index(field or "query")
+                    continue
+                if line_column is None:
+                    value = line.strip()
+                else:
+                    values = line.rstrip("\n").split(line_delimiter)
+                    if len(values) <= line_column:
+                        continue
+                    value = values[line_column].strip()
+                #Zeek writes - for an empty field
+                if value and value != "-":
+                    yield value
+
+def windows(domains, window):
+    #Counts the reduced domains in each window of lines
+    while True:
+        counts = collections.Counter(public_suffix.reduce_domains(itertools.islice(domains, window)))
+        if not counts:
+            break
+        yield counts
+
+def init_worker(database_file, index_file, rdap_url, format_name):
+    global database, rdap_engine, output_format
+    #Workers only read. The parent process writes first contacts and RDAP records.
+    database = database_io.DomainStatsDatabase(database_file, pool_size=2, read_only=True)
+    if index_file:
+        database.open_index(index_file)
+    if rdap_url:
+        rdap_engine = rdap_query.RdapEngine(rdap_url)
+    output_format = format_name
+
+def enrich(counts):
+    """Resolve a list of (domain, count). Returns the output text and the update_record arguments the parent should write."""
+    now = datetime.datetime.utcnow()
+    established = now - datetime.timedelta(days=365*2)
+    records = database.get_records([domain for domain, _ in counts])
+    rdap_records = {}
+    if rdap_engine:
+        rdap_records = rdap_engine.get_domain_records([domain for domain, _ in counts if not records[domain][0]])
+    output = io.StringIO()
+    writer = csv.writer(output) if output_format == "csv" else None
+    writes = []
+    for domain, count in counts:
+        web, expires, isc, you = records[domain]
+        alerts = []
+        if web:
+            if you == "FIRST-CONTACT":
+                you = now
+                alerts.append("YOUR-FIRST-CONTACT")
+                writes.append((domain, web, expires, isc, you))
+        elif domain in rdap_records:
+            web, expires, error = rdap_records[domain]
+            if web in ("ERROR", "THROTTLED"):
+                web = isc = you = category = "ERROR"
+                alerts.append(error)
+            else:
+                web, expires, isc, you = utc(web), utc(expires), "RDAP", now
+                alerts.append("YOUR-FIRST-CONTACT")
+                writes.append((domain, web, expires, isc, you))
+        else:
+            web = isc = you = category = "ERROR"
+            alerts.append("NOT-IN-DATABASE")
+        if web != "ERROR":
+            category = "ESTABLISHED" if web < established else "NEW"
+        record = {"domain": domain, "count": count, "seen_by_web": web, "seen_by_isc": isc, "seen_by_you": you, "category": category, "alerts": alerts}
+        if writer:
+            record["alerts"] = ";".join(alerts)
+            writer.writerow([dateconverter(record[name]) or record[name] for name in CSV_FIELDS])
+        else:
+            output.write(json.dumps(record, default=dateconverter))
+            output.write("\n")
+    return output.getvalue(), writes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', nargs='*', default=['-'], help='Files to read. gzip files are detected. - or nothing reads stdin.')
+    parser.add_argument('-d','--database', default='domain_stats.db', help='The domain_stats database')
+    parser.add_argument('-o','--output', default='-', help='Output file. Defaults to stdout.')
+    parser.add_argument('-f','--format', choices=['jsonl', 'csv'], default='jsonl', help='One json object per line or csv with a header')
+    parser.add_argument('--column', type=int, help='0 based column of the domain in each line. By default the whole line or a Zeek log\'s query field.')
+    parser.add_argument('--delimiter', help='Column delimiter. Defaults to whitespace or the Zeek log\'s separator.')
+    parser.add_argument('--field', help='Zeek field with the domain. Defaults to query.')
+    parser.add_argument('-w','--window', type=int, default=1000000, help='Lines deduplicated together')
+    parser.add_argument('-p','--processes', type=int, default=os.cpu_count(), help='Worker processes')
+    parser.add_argument('--chunk', type=int, default=500, help='Domains sent to a worker at a time')
+    parser.add_argument('--psl', default='public_suffix_list.dat', help='Public Suffix List used to reduce the domains')
+    parser.add_argument('--index', help='Domain index compiled by database_admin --compile')
+    parser.add_argument('--rdap', metavar='URL', nargs='?', const='https://www.rdap.net', help='Look up domains that are not in the database with RDAP')
+    parser.add_argument('--keep-seen-by-you', action='store_true', help='Do not record first contacts or RDAP records in the database')
+    args = parser.parse_args()
+
+    if not pathlib.Path(args.database).exists():
+        print(f"Database {args.database} not found.", file=sys.stderr)
+        sys.exit(1)
+    public_suffix.load(args.psl)
+    writer_db = None
+    if not args.keep_seen_by_you:
+        writer_db = database_io.DomainStatsDatabase(args.database)
+        writer_db.start_write_behind()
+    out = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    if args.format == "csv":
+        csv.writer(out).writerow(CSV_FIELDS)
+    start = time.perf_counter()
+    lines = records = 0
+    pool = multiprocessing.Pool(args.processes, init_worker, (args.database, args.index, args.rdap, args.format))
+    try:
+        domains = read_domains(args.input, args.column, args.delimiter, args.field)
+        for counts in windows(domains, args.window):
+            lines += sum(counts.values())
+            records += len(counts)
+            items = list(counts.items())
+            chunks = [items[pos:pos+args.chunk] for pos in range(0, len(items), args.chunk)]
+            for text, writes in pool.imap(enrich, chunks):
+                out.write(text)
+                if writer_db:
+                    for write in writes:
+                        writer_db.update_record(*write)
+            if writer_db:
+                #The next window must see the first contacts recorded in this one
+                writer_db.flush()
+    finally:
+        pool.close()
+        pool.join()
+        if writer_db:
+            writer_db.close()
+        if out is not sys.stdout:
+            out.close()
+    elapsed = max(time.perf_counter() - start, 0.000001)
+    print(f"Enriched {lines} lines into {records} records in {elapsed:.2f} seconds ({lines/elapsed:.0f} lines/sec).", file=sys.stderr)